@@ -0,0 +1,49 @@
+"""
+Measure the startup time of the wallhaven entry scripts
+
+Each script is run with --help, which exits right after parsing arguments,
+so the time is dominated by interpreter start and module imports, e.g. any
+cache loaded at import time. Run from the repository root:
+
+    python benchmarks/bench_startup.py [-n RUNS]
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Label -> command line arguments given to the interpreter
+TARGETS = {
+    'fetch_daily_wallhaven.py': ['fetch_daily_wallhaven.py', '--help'],
+    'fetch_wallhaven_wallpaper_info.py': ['fetch_wallhaven_wallpaper_info.py', '--help'],
+    'import src.wallhaven.filter': ['-c', 'import src.wallhaven.filter'],
+    'python (baseline)': ['-c', 'pass'],
+}
+
+
+def time_run(args: list[str]) -> float:
+    t = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', nargs='?', type=int, default=10,
+                        help='Number of runs per script (Default 10)')
+    args = parser.parse_args()
+
+    print(f"{'target':<40} {'min (ms)':>10} {'median (ms)':>12}")
+    for label, target_args in TARGETS.items():
+        times = [time_run(target_args) for _ in range(args.runs)]
+        print(f'{label:<40} {min(times) * 1000:>10.1f} {statistics.median(times) * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import logging
+import argparse
+
+from src.logger import MyLogger
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-D', '--dir', nargs='?', type=str, default=None,
+                    help="Base directory of saved wallpaper files, if not given, environment variable WALLHAVEN_DIR or current folder will be used")
+parser.add_argument('-S', '--store-dir', nargs='?', type=str, default=None,
+                    help='Folder of the content-addressed store (Default <DIR>/.store)')
+parser.add_argument('--symlink', action='store_true',
+                    help='Use symlinks instead of hardlinks to the content-addressed store')
+parser.add_argument('-w', '--workers', nargs='?', type=int, default=8,
+                    help='Number of workers hashing files (Default 8)')
+parser.add_argument('-l', '--log-file', nargs='?', type=str, default=None,
+                    help='Log file to store logging information')
+parser.add_argument('-o', '--keep-output', action='store_true',
+                    help='Leave output when set log-file')
+
+args = parser.parse_args()
+
+logger = MyLogger('data-fetch-utils.wallhaven')
+logger.handlers.clear()
+
+formatter = logging.Formatter(
+    fmt='%(asctime)s | %(levelname)s | %(message)s',
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(formatter)
+stream_handler.setLevel(logging.DEBUG)
+
+if args.log_file is not None:
+    file_handler = logging.FileHandler(args.log_file)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.INFO)
+
+    logger.addHandler(file_handler)
+
+if args.log_file is None or args.keep_output:
+    logger.addHandler(stream_handler)
+
+logger.setLevel(logging.DEBUG)
+
+from src.wallhaven.index import DownloadIndex
+from src.wallhaven.store import ContentStore
+
+base_dir = args.dir if args.dir is not None else (os.getenv('WALLHAVEN_DIR') or '.')
+store_dir = args.store_dir if args.store_dir is not None else os.path.join(base_dir, '.store')
+
+# Reuse the hashes recorded when downloading, for files not touched since
+index = DownloadIndex(base_dir)
+known_hashes = {}
+for wid, entry in index.items():
+    if not os.path.isfile(entry.path):
+        index.invalidate(wid, 'is gone')
+    elif entry.hash is not None and os.path.getmtime(entry.path) == entry.mtime:
+        known_hashes[os.path.abspath(entry.path)] = entry.hash
+
+store = ContentStore(store_dir, link='symlink' if args.symlink else 'hard')
+store.dedupe(base_dir, workers=args.workers, known_hashes=known_hashes)
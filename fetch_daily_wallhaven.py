@@ -14,8 +14,37 @@ parser.add_argument('-D', '--dir', nargs='?', type=str, default=None,
                     help="Base directory to save wallpaper files, if not given, environment variable WALLHAVEN_DIR or current folder will be used")
 parser.add_argument('-p', '--page', nargs='?', type=str, default='1-50',
                     help="Range of page to dwonload, use dash (-) for range, comma for separation")
+parser.add_argument('-k', '--stop-after-known', nargs='?', type=int, default=24,
+                    help='Stop searching after seeing this many consecutive wallpapers already'
+                    ' cached or downloaded, 0 to search all pages (Default 24)')
 parser.add_argument('-i', '--interval', nargs='?', type=int, default=2,
                     help='Waiting interval between two downloads or requests')
+parser.add_argument('-b', '--burst', nargs='?', type=int, default=1,
+                    help='Number of requests allowed to be made in a burst (Default 1)')
+parser.add_argument('-s', '--shared-rate-limit', action='store_true',
+                    help='Share the rate limit with other fetchers running on this host')
+parser.add_argument('-x', '--pipeline', action='store_true',
+                    help='Overlap searching, detail fetching and downloading')
+parser.add_argument('--detail-workers', nargs='?', type=int, default=4,
+                    help='Number of workers fetching details, all under the same rate limit (Default 4)')
+parser.add_argument('--download-workers', nargs='?', type=int, default=2,
+                    help='Number of workers downloading files when using --pipeline (Default 2)')
+parser.add_argument('-r', '--resume', action='store_true',
+                    help='Resume the last interrupted run, skipping the work already done')
+parser.add_argument('-a', '--adaptive', action='store_true',
+                    help='Adapt request rate and concurrency to the 429 responses of the server')
+parser.add_argument('--rebuild-index', action='store_true',
+                    help='Rescan the base directory to rebuild the index of downloaded files')
+parser.add_argument('--verify-index', action='store_true',
+                    help='Check that indexed files are still on disk before skipping their download')
+parser.add_argument('-S', '--store-dir', nargs='?', type=str, default=None,
+                    help='Keep downloaded files in a content-addressed store in this folder,'
+                    ' linked from the base directory, so duplicates are only saved once')
+parser.add_argument('--symlink', action='store_true',
+                    help='Use symlinks instead of hardlinks to the content-addressed store')
+parser.add_argument('--cache-backend', nargs='?', type=str, default=None, choices=['pickle', 'sqlite', 'segments'],
+                    help='Backend of the wallpaper info cache, if not given, environment variable'
+                    ' WALLHAVEN_CACHE_BACKEND or pickle will be used')
 parser.add_argument('-C', '--categories', nargs='?', type=str, default='111',
                     help='Flag for categories (General/Anime/People) in form of 101 (Default 111)')
 parser.add_argument('-P', '--purities', nargs='?', type=str, default='110',
@@ -73,6 +102,20 @@ daily_fetcher = DailyFetcher(
     page_range=page_range,
     purities=purities,
     categories=categories,
-    interval=args.interval
+    stop_after_known=args.stop_after_known or None,
+    interval=args.interval,
+    burst=args.burst,
+    shared_rate_limit=args.shared_rate_limit,
+    rebuild_index=args.rebuild_index,
+    verify_index=args.verify_index,
+    store_dir=args.store_dir,
+    store_link='symlink' if args.symlink else 'hard',
+    cache_backend=args.cache_backend,
+    detail_workers=args.detail_workers,
+    resume=args.resume,
+    adaptive=args.adaptive
 )
-daily_fetcher.run()
+if args.pipeline:
+    daily_fetcher.run_pipelined(download_workers=args.download_workers)
+else:
+    daily_fetcher.run()
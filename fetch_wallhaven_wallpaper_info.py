@@ -5,7 +5,6 @@ import logging
 import argparse
 
 from src.logger import MyLogger
-from src.wallhaven.fetcher import IDFetcher
 
 parser = argparse.ArgumentParser()
 parser.add_argument('wall_ids', nargs='*', type=str, default=[],
@@ -18,6 +17,32 @@ parser.add_argument('-I', '--input', nargs='?', type=str, default="",
                     help='Input file containing one wallpaper id per line')
 parser.add_argument('-i', '--interval', nargs='?', type=int, default=2,
                     help='Waiting interval between two downloads or requests')
+parser.add_argument('-b', '--burst', nargs='?', type=int, default=1,
+                    help='Number of requests allowed to be made in a burst (Default 1)')
+parser.add_argument('-s', '--shared-rate-limit', action='store_true',
+                    help='Share the rate limit with other fetchers running on this host')
+parser.add_argument('-x', '--pipeline', action='store_true',
+                    help='Overlap searching, detail fetching and downloading')
+parser.add_argument('--detail-workers', nargs='?', type=int, default=4,
+                    help='Number of workers fetching details, all under the same rate limit (Default 4)')
+parser.add_argument('--download-workers', nargs='?', type=int, default=2,
+                    help='Number of workers downloading files when using --pipeline (Default 2)')
+parser.add_argument('-r', '--resume', action='store_true',
+                    help='Resume the last interrupted run, skipping the work already done')
+parser.add_argument('-a', '--adaptive', action='store_true',
+                    help='Adapt request rate and concurrency to the 429 responses of the server')
+parser.add_argument('--rebuild-index', action='store_true',
+                    help='Rescan the base directory to rebuild the index of downloaded files')
+parser.add_argument('--verify-index', action='store_true',
+                    help='Check that indexed files are still on disk before skipping their download')
+parser.add_argument('-S', '--store-dir', nargs='?', type=str, default=None,
+                    help='Keep downloaded files in a content-addressed store in this folder,'
+                    ' linked from the base directory, so duplicates are only saved once')
+parser.add_argument('--symlink', action='store_true',
+                    help='Use symlinks instead of hardlinks to the content-addressed store')
+parser.add_argument('--cache-backend', nargs='?', type=str, default=None, choices=['pickle', 'sqlite', 'segments'],
+                    help='Backend of the wallpaper info cache, if not given, environment variable'
+                    ' WALLHAVEN_CACHE_BACKEND or pickle will be used')
 parser.add_argument('-l', '--log-file', nargs='?', type=str, default=None,
                     help='Log file to store logging information')
 parser.add_argument('-o', '--keep-output', action='store_true',
@@ -48,16 +73,32 @@ if args.log_file is None or args.keep_output:
 
 logger.setLevel(logging.DEBUG)
 
+from src.wallhaven.fetcher import IDFetcher
+
 wall_ids = args.wall_ids
 if os.path.isfile(args.input):
     with open(args.input, 'r') as f:
         data = f.readlines()
-    wall_ids += data
+    # Blank lines and repeated ids are dropped by IDFetcher
+    wall_ids += [line.strip() for line in data]
 
 id_fetcher = IDFetcher(
     wall_ids = wall_ids,
     download_file=args.download_files,
     base_dir=args.dir,
-    interval=args.interval
+    interval=args.interval,
+    burst=args.burst,
+    shared_rate_limit=args.shared_rate_limit,
+    rebuild_index=args.rebuild_index,
+    verify_index=args.verify_index,
+    store_dir=args.store_dir,
+    store_link='symlink' if args.symlink else 'hard',
+    cache_backend=args.cache_backend,
+    detail_workers=args.detail_workers,
+    resume=args.resume,
+    adaptive=args.adaptive
 )
-id_fetcher.run()
+if args.pipeline:
+    id_fetcher.run_pipelined(download_workers=args.download_workers)
+else:
+    id_fetcher.run()
@@ -1,12 +1,15 @@
 """
 Define common exceptions used when fetching data
 """
+from typing import Optional
 
 
 class TooManyRequestsError(Exception):
 
-    def __init__(self, *args: object) -> None:
+    def __init__(self, retry_after: Optional[float] = None) -> None:
         super().__init__("Too many request error with code 429")
+        # Seconds the server asked to wait with the Retry-After header, if any
+        self.retry_after = retry_after
 
 class UnauthorizedError(Exception):
 
@@ -23,3 +26,9 @@ class MaxRetryReachedError(Exception):
 
     def __init__(self) -> None:
         super().__init__("Failed after reaching max retries limit")
+
+
+class CorruptDownloadError(Exception):
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f"Downloaded file is corrupt: {reason}")
@@ -1,13 +1,17 @@
 
 import re
 import os
+import itertools
 import time
 import requests
 import logging
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from functools import wraps
 
+from .defs import Wallpaper
 from .enums import Category, Purity, SortingOrder, TopRange, Sorting, Color
+from .session import SessionPool, get_default_session
+from .ratelimit import TokenBucket, AdaptiveLimiter, get_rate_limiter, parse_retry_after, backoff_wait
 from ..exceptions import TooManyRequestsError, UnauthorizedError, UnknownResponseError, MaxRetryReachedError
 
 logger = logging.getLogger('data-fetch-util.wallhaven.api')
@@ -41,37 +45,63 @@ class API:
     #
     # Any other attempts to use an invalid API key will result in a 401 -
     # Unauthorized error.
-    last_request_time = time.time()
+    MAX_REQUEST_RATE = 45 / 60
+
+    # Base of the jittered exponential wait before retrying a request
+    # returned with 429 without Retry-After
+    RETRY_WAIT = 5
 
 
     def __init__(self,
                  apikey: Optional[str] = None,
                  max_retries: int = 5,
-                 request_interval: int = 2):
+                 request_interval: int = 2,
+                 session: Optional[SessionPool] = None,
+                 rate_limiter: Optional[TokenBucket | AdaptiveLimiter] = None):
 
         self.apikey = os.getenv('WALLHAVEN_API_KEY') if apikey is None else apikey
         self.max_retries = max_retries
         self.request_interval = request_interval
+        self.session = session if session is not None else get_default_session()
+        self.rate_limiter = (rate_limiter if rate_limiter is not None
+                             else get_rate_limiter('api', self.request_rate(request_interval)))
+
+    @classmethod
+    def request_rate(cls, request_interval: float) -> float:
+        """Requests per second for the given interval, capped by the API limit"""
+        if request_interval <= 0:
+            return cls.MAX_REQUEST_RATE
+        return min(1 / request_interval, cls.MAX_REQUEST_RATE)
 
     def _request(self, url, method='get', params=dict()) -> requests.Response:
 
         if self.apikey is not None and 'apikey' not in params:
             params['apikey'] = self.apikey
 
-        while time.time() - self.last_request_time <= self.request_interval:
-            time.sleep(.5)
-        
+        self.rate_limiter.acquire()
+
         logger.debug(f'Requesting URL: {url}')
         logger.debug(f'Request method: {method}')
         logger.debug(f'Request params: {params}')
 
-        r = requests.request(method, url, params=params)
-        self.last_request_time = time.time()
+        with self.rate_limiter.slot():
+            r = self.session.request(method, url, params=params)
 
+        try:
+            ret = self._check_response(r)
+        except TooManyRequestsError as e:
+            self.rate_limiter.on_throttled(e.retry_after)
+            raise
+
+        self.rate_limiter.on_success()
+        return ret
+
+    @staticmethod
+    def _check_response(r: requests.Response) -> requests.Response:
         if r.status_code == 200:
             return r
         elif r.status_code == 429:
-            raise TooManyRequestsError
+            raise TooManyRequestsError(retry_after=parse_retry_after(r.headers.get('Retry-After')))
         elif r.status_code == 401:
             raise UnauthorizedError
         else:
@@ -84,9 +114,10 @@ class API:
             try:
                 ret = self._request(url, method=method, params=params)
             except TooManyRequestsError as e:
-                logger.info("Request returned with code 429, waiting to retry")
                 retry += 1
-                time.sleep(5)
+                wait = backoff_wait(retry, e.retry_after, base=self.RETRY_WAIT)
+                logger.info(f"Request returned with code 429, waiting {wait:.1f}s to retry")
+                time.sleep(wait)
             else:
                 return ret
 
@@ -119,6 +150,26 @@ class API:
                page: Optional[int] = None,
                seed: Optional[str] = None) -> requests.Response:
 
+        return self.request(self.SEARCH_API_URL, params=self._search_params(
+            q=q, categories=categories, purity=purity, sorting=sorting, order=order,
+            top_range=top_range, atleast=atleast, resolutions=resolutions, ratios=ratios,
+            colors=colors, page=page, seed=seed))
+
+    @classmethod
+    def _search_params(cls,
+                       q: Optional[str] = None,
+                       categories: Optional[Category] = None,
+                       purity: Optional[Purity] = None,
+                       sorting: Optional[Sorting] = None,
+                       order: Optional[SortingOrder] = None,
+                       top_range: Optional[TopRange] = None,
+                       atleast: Optional[str] = None,
+                       resolutions: Optional[list[str]] = None,
+                       ratios: Optional[list[str]] = None,
+                       colors: Optional[Color] = None,
+                       page: Optional[int] = None,
+                       seed: Optional[str] = None) -> dict[str, str]:
+
         if top_range is not None:
             if sorting is None or sorting != Sorting.TOPLIST:
                 raise ValueError(f'Argument top_range must be used with sorting = toplist')
@@ -149,11 +200,48 @@ class API:
             if var is not None:
 
                 if name == 'atleast':
-                    self._verify_dimension_format(var)
+                    cls._verify_dimension_format(var)
                     params[name] = var
                 else:
-                    map(self._verify_dimension_format, var)            
+                    map(cls._verify_dimension_format, var)            
                     params[name] = ','.join(var)
 
-        return self.request(self.SEARCH_API_URL, params=params)
+        return params
+
+    def iter_pages(self, pages: Optional[Iterable[int]] = None, **kwargs) -> Iterator[dict]:
+        """Lazily request search pages and yield their json one at a time
+
+        pages: pages to request in order, if None, start from page 1 and follow
+            meta.last_page. Pages beyond meta.last_page are never requested.
+
+        Other keyword arguments are the same as API.search. The seed returned
+        with random sorting is passed on to later pages to avoid repeats.
+        """
+        kwargs.pop('page', None)
+        seed = kwargs.pop('seed', None)
+
+        pages = itertools.count(1) if pages is None else pages
+        last_page = None
+        for page in pages:
+            if last_page is not None and page > last_page:
+                logger.debug(f'Page {page} is beyond the last page {last_page}, stop searching')
+                break
+
+            logger.debug(f'Searching wallpapers on page {page}')
+            res_json = self.search(page=page, seed=seed, **kwargs).json()
+            meta = res_json.get('meta') or {}
+
+            last_page = meta.get('last_page', last_page)
+            seed = meta.get('seed') or seed
+
+            yield res_json
+
+            if not res_json.get('data'):
+                logger.debug(f'No wallpaper found on page {page}, stop searching')
+                break
 
+    def iter_search(self, pages: Optional[Iterable[int]] = None, **kwargs) -> Iterator[Wallpaper]:
+        """Yield Wallpaper instances as each search page arrives, see iter_pages"""
+        for res_json in self.iter_pages(pages=pages, **kwargs):
+            for json in res_json['data']:
+                yield Wallpaper(json)
@@ -0,0 +1,207 @@
+
+import os
+import asyncio
+import threading
+from typing import AsyncIterator, Optional
+
+import requests
+
+from .api import API
+from .session import SessionPool, get_default_session
+from .ratelimit import TokenBucket, AdaptiveLimiter, get_rate_limiter, parse_retry_after, backoff_wait
+from ..exceptions import TooManyRequestsError, UnknownResponseError, MaxRetryReachedError
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.async_api')
+
+
+class AsyncAPI:
+    """Asyncio counterpart of API
+
+    Requests run on the pooled session in worker threads, so no extra HTTP
+    dependency is needed. At most max_concurrency requests or downloads are
+    in flight at once, and all of them draw from the same rate limiters as
+    the blocking API.
+    """
+
+    WALLPAPER_INFO_URL = API.WALLPAPER_INFO_URL
+    SEARCH_API_URL = API.SEARCH_API_URL
+
+    def __init__(self,
+                 apikey: Optional[str] = None,
+                 max_retries: int = 5,
+                 request_interval: int = 2,
+                 max_concurrency: int = 4,
+                 session: Optional[SessionPool] = None,
+                 rate_limiter: Optional[TokenBucket | AdaptiveLimiter] = None,
+                 download_limiter: Optional[TokenBucket | AdaptiveLimiter] = None):
+
+        self.apikey = os.getenv('WALLHAVEN_API_KEY') if apikey is None else apikey
+        self.max_retries = max_retries
+        self.request_interval = request_interval
+        self.max_concurrency = max_concurrency
+        self.session = session if session is not None else get_default_session()
+        self.rate_limiter = (rate_limiter if rate_limiter is not None
+                             else get_rate_limiter('api', API.request_rate(request_interval)))
+        self.download_limiter = download_limiter
+
+        # Created on first use so that it binds to the running loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @staticmethod
+    async def _throttle(limiter: Optional[TokenBucket | AdaptiveLimiter]):
+        if limiter is not None:
+            # Shared limiters take a file lock, which must not block the loop
+            wait = await asyncio.to_thread(limiter.reserve)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def _request(self, url, method='get', params=None) -> requests.Response:
+
+        params = dict(params or {})
+        if self.apikey is not None and 'apikey' not in params:
+            params['apikey'] = self.apikey
+
+        await self._throttle(self.rate_limiter)
+
+        logger.debug(f'Requesting URL: {url}')
+        logger.debug(f'Request method: {method}')
+        logger.debug(f'Request params: {params}')
+
+        async with self.semaphore:
+            r = await asyncio.to_thread(self.session.request, method, url, params=params)
+
+        try:
+            ret = API._check_response(r)
+        except TooManyRequestsError as e:
+            self.rate_limiter.on_throttled(e.retry_after)
+            raise
+
+        self.rate_limiter.on_success()
+        return ret
+
+    async def request(self, url, method='get', params=None) -> requests.Response:
+
+        retry = 0
+        while retry < self.max_retries:
+            try:
+                ret = await self._request(url, method=method, params=params)
+            except TooManyRequestsError as e:
+                retry += 1
+                wait = backoff_wait(retry, e.retry_after, base=API.RETRY_WAIT)
+                logger.info(f"Request returned with code 429, waiting {wait:.1f}s to retry")
+                await asyncio.sleep(wait)
+            else:
+                return ret
+
+        raise MaxRetryReachedError
+
+    async def get_wallpaper_info(self, wid) -> requests.Response:
+        return await self.request(self.WALLPAPER_INFO_URL + str(wid))
+
+    async def get_wallpapers_info(self, wids) -> dict[str, requests.Response | Exception]:
+        """Look up the details of several wallpapers concurrently
+
+        Failed lookups are returned as the raised exception instead of
+        aborting the others.
+        """
+        wids = list(wids)
+        results = await asyncio.gather(*(self.get_wallpaper_info(wid) for wid in wids),
+                                       return_exceptions=True)
+        return dict(zip(wids, results))
+
+    async def search(self, **kwargs) -> requests.Response:
+        """Search wallpapers, accepting the same arguments as API.search"""
+        return await self.request(self.SEARCH_API_URL, params=API._search_params(**kwargs))
+
+    async def stream(self, url, chunk_size: int = 32 * 1024,
+                     headers: Optional[dict] = None) -> AsyncIterator[bytes]:
+        """Stream the content of url chunk by chunk
+
+        The concurrency slot is held until the stream is exhausted or closed.
+        """
+        await self._throttle(self.download_limiter)
+
+        async with self.semaphore:
+            r = await asyncio.to_thread(self.session.get, url, stream=True, headers=headers)
+            try:
+                if r.status_code == 429:
+                    raise TooManyRequestsError(retry_after=parse_retry_after(r.headers.get('Retry-After')))
+                elif r.status_code not in (200, 206):
+                    raise UnknownResponseError(r)
+
+                chunks = r.iter_content(chunk_size)
+                while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                    yield chunk
+            finally:
+                r.close()
+
+    async def download(self, url, save_path, chunk_size: int = 32 * 1024) -> int:
+        """Download url to save_path, return the number of bytes written"""
+
+        dirname = os.path.dirname(save_path)
+        if dirname and not os.path.isdir(dirname):
+            logger.debug(f'Making directory {dirname}')
+            os.makedirs(dirname, exist_ok=True)
+
+        wrote = 0
+        with open(save_path, 'wb') as f:
+            async for chunk in self.stream(url, chunk_size=chunk_size):
+                await asyncio.to_thread(f.write, chunk)
+                wrote += len(chunk)
+
+        return wrote
+
+
+class SyncAPIAdapter:
+    """Expose an AsyncAPI through the blocking interface of API
+
+    The coroutines run on an event loop in a daemon thread, so calls made by
+    several fetcher threads overlap up to the AsyncAPI concurrency limit,
+    e.g. Fetcher(api=SyncAPIAdapter(AsyncAPI(max_concurrency=4))).
+    """
+
+    def __init__(self, async_api: Optional[AsyncAPI] = None):
+        self.async_api = async_api if async_api is not None else AsyncAPI()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='wallhaven-async-api', daemon=True)
+        self._thread.start()
+
+    @property
+    def session(self) -> SessionPool:
+        return self.async_api.session
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def request(self, url, method='get', params=None) -> requests.Response:
+        return self._run(self.async_api.request(url, method=method, params=params))
+
+    def get_wallpaper_info(self, wid) -> requests.Response:
+        return self._run(self.async_api.get_wallpaper_info(wid))
+
+    def get_wallpapers_info(self, wids) -> dict[str, requests.Response | Exception]:
+        return self._run(self.async_api.get_wallpapers_info(wids))
+
+    def search(self, **kwargs) -> requests.Response:
+        return self._run(self.async_api.search(**kwargs))
+
+    # Pagination only relies on search, so reuse the blocking implementation
+    iter_pages = API.iter_pages
+    iter_search = API.iter_search
+
+    def download(self, url, save_path, chunk_size: int = 32 * 1024) -> int:
+        return self._run(self.async_api.download(url, save_path, chunk_size=chunk_size))
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
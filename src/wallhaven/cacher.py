@@ -1,65 +1,847 @@
 
 import os
+import re
+import abc
+import json
+import itertools
+import mmap
 import time
 import pickle
-from typing import Optional
+import sqlite3
+import threading
+from typing import Iterator, Optional
+from collections import OrderedDict
 
-from .defs import Wallpaper 
+from .defs import Wallpaper
+from .filelock import FileLock, fcntl
+from .rangeindex import SecondaryIndexes
+from .tagindex import TagIndex
+from .columns import CacheColumns
 from ..logger import MyLogger
 
 logger = MyLogger('data-fetch-utils.wallhaven.cacher')
 
-class Cache:
+# Folder of every cache and state file of the package
+_cache_dir = os.path.join(os.getenv('HOME') or '.',
+                          '.cache',
+                          'data-fetch-utils')
 
-    _cache_file = os.path.join(os.getenv('HOME') or '.',
-                              '.cache',
-                              'data-fetch-utils',
-                              'wallhaven_downloaded.pkl')
 
-    if os.path.isfile(_cache_file):
-        with open(_cache_file, 'rb') as f:
-            _cache = pickle.load(f)
-    else:
-        _cache = {}
+class WallpaperLRU:
+    """Bounded LRU of Wallpaper instances built from cached json
+
+    Hands out the same Wallpaper instance for repeated lookups of an id, so
+    Tags and other derived data are only built once while the number of
+    materialized instances, and so the memory they take, stays capped.
+    Instances are shared and should be treated as read-only.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, Wallpaper] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, wid: str) -> Optional[Wallpaper]:
+        with self._lock:
+            wallpaper = self._entries.get(wid)
+            if wallpaper is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(wid)
+            return wallpaper
+
+    def put(self, wallpaper: Wallpaper):
+        with self._lock:
+            self._entries[wallpaper.id] = wallpaper
+            self._entries.move_to_end(wallpaper.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, wid: str):
+        with self._lock:
+            self._entries.pop(wid, None)
+
+    def resize(self, max_size: int):
+        with self._lock:
+            self.max_size = max_size
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class _CacheState:
+    """Data derived from the entries of one cache storage"""
 
     def __init__(self):
-        logger.debug(f'Loaded {len(self._cache)} entries from cache file {self._cache_file}')
-        self._iter_keys = iter(self._cache.keys())
+        self.generation = 0
+        self.lru = WallpaperLRU()
+        self.secondary: Optional[SecondaryIndexes] = None
+        self.tag_index: Optional[TagIndex] = None
+        self.columns: Optional[CacheColumns] = None
+        self.lock = threading.Lock()
+
+
+class BaseCache(abc.ABC):
+    """Interface of the wallpaper info caches, mapping wallpaper id to its json
+
+    Each storage, i.e. pickle file, database or segment folder, has its own
+    LRU of materialized Wallpaper instances, its own sorted secondary indexes,
+    tag index and columns, shared by all the instances opened on it like the
+    cached entries are. They are built on first use and kept up to date by
+    add from then on.
+
+    The generation of a storage goes up whenever an entry changes, so
+    results derived from the cache can tell whether they are still valid.
+    """
+
+    # Whether an added entry is written out right away, rather than on save
+    DURABLE_ADD = False
+
+    # (backend name, storage path) -> derived data
+    _states: dict[tuple[str, str], _CacheState] = {}
+    _states_lock = threading.Lock()
+
+    @property
+    @abc.abstractmethod
+    def storage_path(self) -> str:
+        """Path of the file or folder the entries are stored in"""
+
+    @property
+    def identity(self) -> tuple[str, str]:
+        """Identifies the storage, caches with the same identity share their entries"""
+        return self.__class__.__name__, os.path.abspath(self.storage_path)
+
+    @property
+    def _state(self) -> _CacheState:
+        key = self.identity
+        state = self._states.get(key)
+        if state is None:
+            with self._states_lock:
+                state = self._states.setdefault(key, _CacheState())
+        return state
 
+    @abc.abstractmethod
     def __len__(self):
-        return len(self._cache)
+        """Number of cached wallpapers"""
 
+    @abc.abstractmethod
     def __contains__(self, val: str):
-        return val in self._cache
+        """Whether the wallpaper id is cached"""
+
+    @abc.abstractmethod
+    def __getitem__(self, key: str) -> dict:
+        """Cached json of the wallpaper id, raise KeyError if not cached"""
+
+    @abc.abstractmethod
+    def keys(self) -> Iterator[str]:
+        """Iterate over the cached wallpaper ids"""
+
+    @abc.abstractmethod
+    def items(self) -> Iterator[tuple[str, dict]]:
+        """Iterate over the cached (wallpaper id, json) pairs"""
+
+    @abc.abstractmethod
+    def _add(self, wallpaper: Wallpaper):
+        """Add or replace the json of the wallpaper in the backend"""
+
+    @abc.abstractmethod
+    def save(self):
+        """Persist the cached entries"""
 
     def __iter__(self):
-        return self
+        # A fresh iterator each time, so the cache can be iterated repeatedly
+        return iter(self.keys())
 
-    def __next__(self):
-        return next(self._iter_keys)
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-    def __getitem__(self, key: str):
-        return self._cache[key]
+    def preload(self):
+        """Start loading the entries ahead of the first access, if supported"""
 
-    def items(self):
-        return self._cache.items()
+    def _updated(self, wid: str, json: dict):
+        """Bring derived data up to date after the json of wid changed"""
+        state = self._state
+        state.generation += 1
+        # Materialized instance may be outdated
+        state.lru.discard(wid)
+        if state.secondary is not None:
+            state.secondary.add(wid, json)
+        if state.tag_index is not None:
+            state.tag_index.add(wid, json)
+        if state.columns is not None:
+            state.columns.add(wid, json)
 
     def add(self, wallpaper: Wallpaper):
-        self._cache[wallpaper.id] = wallpaper.json
+        """Add or replace the json of the wallpaper"""
+        self._add(wallpaper)
+        self._updated(wallpaper.id, wallpaper.json)
 
     def fetch_wallpaper(self, wid: str) -> Optional[Wallpaper]:
-        json = self._cache.get(wid, None)
+        lru = self._state.lru
+        wallpaper = lru.get(wid)
+        if wallpaper is not None:
+            return wallpaper
+
+        json = self.get(wid, None)
         if json:
-            return Wallpaper(json)
+            wallpaper = Wallpaper(json)
+            lru.put(wallpaper)
+            return wallpaper
         else:
             return None
 
+    @property
+    def generation(self) -> int:
+        return self._state.generation
+
+    def resize_lru(self, max_size: int):
+        """Change the max number of materialized Wallpaper instances kept"""
+        self._state.lru.resize(max_size)
+
+    @property
+    def lru_stats(self) -> dict[str, int]:
+        return self._state.lru.stats
+
+    @property
+    def built_secondary_indexes(self) -> Optional[SecondaryIndexes]:
+        """Secondary indexes if already built, None otherwise"""
+        return self._state.secondary
+
+    @property
+    def built_tag_index(self) -> Optional[TagIndex]:
+        """Tag index if already built, None otherwise"""
+        return self._state.tag_index
+
+    @property
+    def secondary_indexes(self) -> SecondaryIndexes:
+        """Sorted indexes over created, ratio, file_size and resolution"""
+        state = self._state
+        with state.lock:
+            if state.secondary is None:
+                indexes = SecondaryIndexes()
+                indexes.build(self.items())
+                state.secondary = indexes
+            return state.secondary
+
+    @property
+    def tag_index(self) -> TagIndex:
+        """Inverted index from tag id and name to cached wallpaper ids"""
+        state = self._state
+        with state.lock:
+            if state.tag_index is None:
+                index = TagIndex()
+                index.build(self.items())
+                state.tag_index = index
+            return state.tag_index
+
+    @property
+    def columns(self) -> CacheColumns:
+        """Columns of the typed fields of every cached wallpaper, needs numpy"""
+        state = self._state
+        with state.lock:
+            if state.columns is None:
+                columns = CacheColumns()
+                columns.build(self.items())
+                state.columns = columns
+            return state.columns
+
+
+class Cache(BaseCache):
+    """Cache kept in memory as a dict and saved to a pickle file
+
+    The pickle file is loaded on first access rather than at import, and is
+    shared by all instances. With preload, loading starts right away in a
+    background thread, so it overlaps with whatever the caller does next.
+
+    Several processes may use the cache file at once, e.g. the daily cron
+    fetcher and a manual IDFetcher run. Entries added since the last save
+    are tracked, and save merges them into whatever is on disk under a file
+    lock, so no process drops the entries written by another one.
+    """
+
+    _cache_file = os.path.join(_cache_dir, 'wallhaven_downloaded.pkl')
+    _file_lock = FileLock(_cache_file + '.lock')
+
+    _cache: Optional[dict] = None
+    _dirty: dict = {}
+    _file_stamp: Optional[tuple[int, int]] = None
+    _load_lock = threading.RLock()
+    _loader: Optional[threading.Thread] = None
+
+    def __init__(self, preload: bool = False):
+        if preload:
+            self.preload()
+
+    @property
+    def storage_path(self) -> str:
+        return self._cache_file
+
+    @classmethod
+    def _stat_file(cls) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(cls._cache_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def _read_file(cls) -> dict:
+        # The file is replaced atomically on save, so no lock is needed to read
+        stamp = cls._stat_file()
+        if stamp is None:
+            return {}
+
+        with open(cls._cache_file, 'rb') as f:
+            ret = pickle.load(f)
+        cls._file_stamp = stamp
+        return ret
+
+    @classmethod
+    def _load(cls) -> dict:
+        with cls._load_lock:
+            if cls._cache is None:
+                t = time.time()
+                cls._cache = cls._read_file()
+                logger.debug(f'Loaded {len(cls._cache)} entries from cache file {cls._cache_file}'
+                             f' in {time.time() - t:.2f}s')
+            return cls._cache
+
+    @classmethod
+    def preload(cls):
+        with cls._load_lock:
+            if cls._cache is not None or cls._loader is not None:
+                return
+            cls._loader = threading.Thread(target=cls._load, name='wallhaven-cache-loader', daemon=True)
+            cls._loader.start()
+
+    @property
+    def _data(self) -> dict:
+        # Blocks on the lock while a background load is in progress
+        cache = self._cache
+        return cache if cache is not None else self._load()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, val: str):
+        return val in self._data
+
+    def __getitem__(self, key: str):
+        return self._data[key]
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def _add(self, wallpaper: Wallpaper):
+        cache = self._data
+        json = wallpaper.json
+        with self._load_lock:
+            cache[wallpaper.id] = json
+            self._dirty[wallpaper.id] = json
+
     def save(self):
         dirname = os.path.dirname(self._cache_file)
         if not os.path.isdir(dirname):
             logger.debug(f'Cache folder {dirname} does not exist, create one')
             os.makedirs(dirname)
 
-        with open(self._cache_file, 'wb') as f:
-            pickle.dump(self._cache, f)
-            logger.debug(f'Saved {len(self._cache)} cached entries to {self._cache_file}')
+        cache = self._data
+        with self._file_lock, self._load_lock:
+            # Another process saved since we last read the file, pick up its
+            # entries and put ours back on top
+            if self._stat_file() != self._file_stamp:
+                on_disk = self._read_file()
+                logger.debug(f'Cache file {self._cache_file} changed on disk, merging'
+                             f' {len(self._dirty)} local entries into {len(on_disk)} entries')
+                # Only the entries another process changed need derived data updated
+                changed = [wid for wid, json in on_disk.items()
+                           if wid not in self._dirty and cache.get(wid) != json]
+                cache.update(on_disk)
+                cache.update(self._dirty)
+                for wid in changed:
+                    self._updated(wid, on_disk[wid])
+
+            tmp_file = self._cache_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(cache, f)
+            os.replace(tmp_file, self._cache_file)
+
+            self.__class__._file_stamp = self._stat_file()
+            self._dirty.clear()
+            logger.debug(f'Saved {len(cache)} cached entries to {self._cache_file}')
+
+
+class SQLiteCache(BaseCache):
+    """Cache stored in a SQLite database in WAL mode
+
+    Every add is a single-row upsert committed on its own, so the cost of
+    persisting does not grow with the size of the cache and save has nothing
+    left to do. The pickle cache is imported once when the database is new.
+    """
+
+    _db_file = os.path.join(_cache_dir, 'wallhaven_cache.sqlite')
+
+    DURABLE_ADD = True
+
+    # One connection per database shared by all instances and threads
+    _connections: dict[str, sqlite3.Connection] = {}
+    _lock = threading.RLock()
+
+    def __init__(self, db_file: Optional[str] = None):
+        self.db_file = db_file if db_file is not None else self._db_file
+        self._conn = self._connect(self.db_file)
+        logger.debug(f'Opened {len(self)} entries from cache database {self.db_file}')
+
+    @property
+    def storage_path(self) -> str:
+        return self.db_file
+
+    @classmethod
+    def _connect(cls, db_file: str) -> sqlite3.Connection:
+        with cls._lock:
+            if db_file in cls._connections:
+                return cls._connections[db_file]
+
+            dirname = os.path.dirname(db_file)
+            if dirname and not os.path.isdir(dirname):
+                logger.debug(f'Cache folder {dirname} does not exist, create one')
+                os.makedirs(dirname)
+
+            # Autocommit mode, transactions are opened explicitly when needed
+            conn = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS wallpapers ('
+                         'id TEXT PRIMARY KEY, json TEXT NOT NULL)')
+
+            cls._connections[db_file] = conn
+
+            if conn.execute('SELECT COUNT(*) FROM wallpapers').fetchone()[0] == 0:
+                cls._migrate_from_pickle(conn, Cache._cache_file)
+
+            return conn
+
+    @staticmethod
+    def _migrate_from_pickle(conn: sqlite3.Connection, pkl_file: str):
+        if not os.path.isfile(pkl_file):
+            return
+
+        t = time.time()
+        with open(pkl_file, 'rb') as f:
+            cache = pickle.load(f)
+
+        conn.execute('BEGIN')
+        conn.executemany('INSERT OR REPLACE INTO wallpapers (id, json) VALUES (?, ?)',
+                         ((wid, json.dumps(data)) for wid, data in cache.items()))
+        conn.execute('COMMIT')
+
+        logger.info(f'Migrated {len(cache)} entries from {pkl_file} in {time.time() - t:.2f}s')
+
+    def _execute(self, sql: str, params=()) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM wallpapers')[0][0]
+
+    def __contains__(self, val: str):
+        return bool(self._execute('SELECT 1 FROM wallpapers WHERE id = ?', (val, )))
+
+    def __getitem__(self, key: str):
+        rows = self._execute('SELECT json FROM wallpapers WHERE id = ?', (key, ))
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def keys(self):
+        return (row[0] for row in self._execute('SELECT id FROM wallpapers'))
+
+    def items(self):
+        return ((wid, json.loads(data))
+                for wid, data in self._execute('SELECT id, json FROM wallpapers'))
+
+    def _add(self, wallpaper: Wallpaper):
+        self._execute('INSERT OR REPLACE INTO wallpapers (id, json) VALUES (?, ?)',
+                      (wallpaper.id, json.dumps(wallpaper.json)))
+
+    def save(self):
+        # Entries are committed as they are added
+        logger.debug(f'Cache database {self.db_file} has {len(self)} entries')
+
+
+class SegmentCache(BaseCache):
+    """Cache stored as append-only segment files with an in-memory offset index
+
+    Each record is one line of <id>\\t<json> appended to the active segment,
+    so add is a single small write. Loading memory-maps the segments and only
+    reads the ids to build the index (id -> segment, offset, length); the
+    json of a record is parsed when it is looked up. Records rewritten later,
+    e.g. after Wallpaper.update, supersede the earlier ones, which compaction
+    drops by merging the full segments into one in a background thread.
+
+    Intended for hosts where SQLite is not an option. Several processes may
+    append at once, but each one only sees the others' records after reload.
+    """
+
+    _segment_dir = os.path.join(_cache_dir, 'wallhaven_segments')
+
+    DURABLE_ADD = True
+    _name_pattern = re.compile(r'^segment-(\d{6})-(\d{3})\.log$')
+
+    # Segments stop receiving appends once they reach this size
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Compact on save when more than this fraction of records is superseded
+    COMPACT_RATIO = 0.5
+
+    # id -> (segment key, offset, length), segment key being (number, generation)
+    _index: Optional[dict[str, tuple[tuple[int, int], int, int]]] = None
+    _maps: dict[tuple[int, int], mmap.mmap] = {}
+    _active: Optional[tuple[int, int]] = None
+    _active_fd: Optional[int] = None
+    _segment_records: dict[tuple[int, int], int] = {}
+    _num_records = 0
+
+    _lock = threading.RLock()
+    _loader: Optional[threading.Thread] = None
+    _compactor: Optional[threading.Thread] = None
+
+    def __init__(self, preload: bool = False):
+        if preload:
+            self.preload()
+
+    @property
+    def storage_path(self) -> str:
+        return self._segment_dir
+
+    @classmethod
+    def _path(cls, key: tuple[int, int]) -> str:
+        return os.path.join(cls._segment_dir, 'segment-%06d-%03d.log' % key)
+
+    @classmethod
+    def _list_segments(cls) -> list[tuple[int, int]]:
+        keys = []
+        for name in os.listdir(cls._segment_dir):
+            m = cls._name_pattern.match(name)
+            if m:
+                keys.append((int(m.group(1)), int(m.group(2))))
+        return sorted(keys)
+
+    @classmethod
+    def _flock(cls, shared: bool) -> Optional[int]:
+        """Lock segments against compaction, shared by appenders, exclusive to compact"""
+        if fcntl is None:
+            return None
+        fd = os.open(os.path.join(cls._segment_dir, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _funlock(fd: Optional[int]):
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @staticmethod
+    def _scan(key: tuple[int, int], buf, index: dict, start: int = 0, end: Optional[int] = None) -> int:
+        """Add the records of buf[start:end] to index, return the number of records"""
+        end = len(buf) if end is None else end
+        num_records = 0
+        pos = start
+        while pos < end:
+            eol = buf.find(b'\n', pos, end)
+            if eol < 0:
+                # Truncated record left by a crash
+                break
+            tab = buf.find(b'\t', pos, eol)
+            if tab > pos:
+                index[buf[pos:tab].decode()] = (key, tab + 1, eol - tab - 1)
+                num_records += 1
+            pos = eol + 1
+        return num_records
+
+    @classmethod
+    def _map(cls, key: tuple[int, int]) -> Optional[mmap.mmap]:
+        with open(cls._path(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def _load(cls) -> dict:
+        with cls._lock:
+            if cls._index is None:
+                t = time.time()
+                os.makedirs(cls._segment_dir, exist_ok=True)
+
+                index = {}
+                lock_fd = cls._flock(shared=True)
+                try:
+                    for key in cls._list_segments():
+                        buf = cls._map(key)
+                        if buf is None:
+                            continue
+                        cls._segment_records[key] = cls._scan(key, buf, index)
+                        cls._maps[key] = buf
+                finally:
+                    cls._funlock(lock_fd)
+                cls._num_records = sum(cls._segment_records.values())
+
+                cls._index = index
+                logger.debug(f'Loaded {len(index)} entries from {len(cls._maps)} segments in'
+                             f' {cls._segment_dir} in {time.time() - t:.2f}s')
+            return cls._index
+
+    @classmethod
+    def preload(cls):
+        with cls._lock:
+            if cls._index is not None or cls._loader is not None:
+                return
+            cls._loader = threading.Thread(target=cls._load, name='wallhaven-cache-loader', daemon=True)
+            cls._loader.start()
+
+    @classmethod
+    def _reload(cls) -> dict:
+        """Rebuild the index from the segments now on disk"""
+        with cls._lock:
+            logger.debug(f'Segments in {cls._segment_dir} changed on disk, reloading')
+            # Maps are dropped rather than closed, a compaction running in
+            # the background may still be copying from them
+            cls._maps.clear()
+            cls._segment_records.clear()
+            cls._index = None
+            return cls._load()
+
+    @property
+    def _data(self) -> dict:
+        index = self._index
+        return index if index is not None else self._load()
+
+    def _read(self, loc: tuple[tuple[int, int], int, int]) -> bytes:
+        key, offset, length = loc
+        if key == self._active:
+            return os.pread(self._active_fd, length, offset)
+
+        buf = self._maps.get(key)
+        if buf is None or offset + length > len(buf):
+            # Segment has grown since mapped, e.g. appended by another process
+            buf = self._maps[key] = self._map(key)
+        return buf[offset:offset + length]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, val: str):
+        return val in self._data
+
+    def __getitem__(self, key: str):
+        index = self._data
+        with self._lock:
+            try:
+                return json.loads(self._read(index[key]))
+            except FileNotFoundError:
+                # Segment compacted and removed by another process, the
+                # record now lives in the merged segment
+                index = self._reload()
+                return json.loads(self._read(index[key]))
+
+    def keys(self):
+        return list(self._data)
+
+    def items(self):
+        for wid in self.keys():
+            yield wid, self[wid]
+
+    @classmethod
+    def _open_active(cls):
+        # Appends go to a fresh segment number, compacted segments keep the
+        # number of the last segment they merged with a higher generation
+        keys = cls._list_segments()
+        if keys and keys[-1][1] == 0 and os.path.getsize(cls._path(keys[-1])) < cls.SEGMENT_SIZE:
+            key = keys[-1]
+        else:
+            key = (keys[-1][0] + 1 if keys else 1, 0)
+
+        cls._active = key
+        cls._active_fd = os.open(cls._path(key), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        cls._maps.pop(key, None)
+
+    @classmethod
+    def _seal_active(cls):
+        os.close(cls._active_fd)
+        cls._maps[cls._active] = cls._map(cls._active)
+        cls._active = cls._active_fd = None
+
+    def _add(self, wallpaper: Wallpaper):
+        index = self._data
+        record = (f'{wallpaper.id}\t'
+                  + json.dumps(wallpaper.json, separators=(',', ':'))
+                  + '\n').encode()
+
+        with self._lock:
+            if self._active is None:
+                self._open_active()
+
+            fd = self._flock(shared=True)
+            try:
+                # Roll over before writing so that a full segment is never
+                # appended to again, by this or any other process
+                if os.fstat(self._active_fd).st_size >= self.SEGMENT_SIZE:
+                    self._seal_active()
+                    self._open_active()
+
+                os.write(self._active_fd, record)
+                end = os.lseek(self._active_fd, 0, os.SEEK_CUR)
+            finally:
+                self._funlock(fd)
+
+            id_len = len(wallpaper.id.encode()) + 1
+            index[wallpaper.id] = (self._active, end - len(record) + id_len, len(record) - id_len - 1)
+            self._segment_records[self._active] = self._segment_records.get(self._active, 0) + 1
+            self.__class__._num_records += 1
+
+    def save(self):
+        index = self._data
+        with self._lock:
+            if self._active_fd is not None:
+                os.fsync(self._active_fd)
+
+            num_superseded = self._num_records - len(index)
+            logger.debug(f'Segment cache has {len(index)} entries and {num_superseded} superseded records')
+
+        if self._num_records and num_superseded / self._num_records > self.COMPACT_RATIO:
+            self.compact(background=True)
+
+    @classmethod
+    def compact(cls, background: bool = False):
+        """Merge the full segments into one, dropping superseded records"""
+        with cls._lock:
+            if cls._compactor is not None and cls._compactor.is_alive():
+                return
+            if background:
+                cls._compactor = threading.Thread(target=cls._compact, name='wallhaven-cache-compactor',
+                                                  daemon=True)
+                cls._compactor.start()
+                return
+        cls._compact()
+
+    @classmethod
+    def _compactable(cls) -> list[tuple[int, int]]:
+        """Leading segments that no process appends to anymore"""
+        ret = []
+        for key in cls._list_segments():
+            if key == cls._active or not (key[1] > 0 or os.path.getsize(cls._path(key)) >= cls.SEGMENT_SIZE):
+                break
+            ret.append(key)
+        return ret
+
+    @classmethod
+    def _compact(cls):
+        index = cls._load()
+        t = time.time()
+
+        with cls._lock:
+            # Segments must stay a contiguous prefix for later records to win
+            sealed = list(itertools.takewhile(lambda key: cls._maps.get(key) is not None,
+                                              cls._compactable()))
+            if not sealed:
+                return
+            maps = {key: cls._maps[key] for key in sealed}
+            live = {wid: loc for wid, loc in index.items() if loc[0] in maps}
+            num_records = sum(cls._segment_records.get(key, 0) for key in sealed)
+
+            if len(sealed) < 2 and num_records == len(live):
+                logger.debug('No segment to compact')
+                return
+
+        sizes = {key: len(buf) for key, buf in maps.items()}
+        target = (sealed[-1][0], sealed[-1][1] + 1)
+        tmp_path = cls._path(target) + '.tmp'
+
+        def _write(f, items) -> dict:
+            locs = {}
+            for wid, (key, offset, length) in items:
+                f.write(wid.encode() + b'\t')
+                locs[wid] = (target, f.tell(), length)
+                f.write(maps[key][offset:offset + length])
+                f.write(b'\n')
+            return locs
+
+        # Full segments are never appended to, so they are copied without
+        # blocking adds to the active segment
+        with open(tmp_path, 'wb') as f:
+            new_locs = _write(f, sorted(live.items(), key=lambda x: x[1]))
+
+            lock_fd = cls._flock(shared=False)
+            try:
+                # Pick up records appended by others right before they rolled over
+                tail = {}
+                for key in sealed:
+                    grown = cls._map(key)
+                    if grown is not None and len(grown) > sizes[key]:
+                        maps[key] = grown
+                        cls._scan(key, grown, tail, start=sizes[key])
+                new_locs.update(_write(f, tail.items()))
+                f.flush()
+                os.fsync(f.fileno())
+
+                os.replace(tmp_path, cls._path(target))
+                for key in sealed:
+                    os.remove(cls._path(key))
+            finally:
+                cls._funlock(lock_fd)
+
+        with cls._lock:
+            for wid, loc in new_locs.items():
+                # Entries rewritten while compacting point to the active segment
+                if wid not in index or index[wid][0] in maps:
+                    index[wid] = loc
+            for key in sealed:
+                cls._maps.pop(key, None)
+                cls._num_records -= cls._segment_records.pop(key, 0)
+            cls._maps[target] = cls._map(target)
+            cls._segment_records[target] = len(new_locs)
+            cls._num_records += len(new_locs)
+
+        logger.info(f'Compacted {len(sealed)} segments into {cls._path(target)} with'
+                    f' {len(new_locs)} of {num_records} records in {time.time() - t:.2f}s')
+
+CACHE_BACKENDS = {
+    'pickle': Cache,
+    'sqlite': SQLiteCache,
+    'segments': SegmentCache,
+}
+
+
+def open_cache(backend: Optional[str] = None) -> BaseCache:
+    """Open the cache of the given backend
+
+    backend: one of CACHE_BACKENDS, if None, environment variable
+        WALLHAVEN_CACHE_BACKEND or pickle will be used
+    """
+    if backend is None:
+        backend = os.getenv('WALLHAVEN_CACHE_BACKEND') or 'pickle'
+
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f'Given cache backend {backend} should be one of {list(CACHE_BACKENDS)}')
+
+    return CACHE_BACKENDS[backend]()
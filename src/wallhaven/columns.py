@@ -0,0 +1,223 @@
+
+import datetime as dt
+import threading
+from typing import Iterable, Optional
+
+from .defs import Wallpaper
+from .enums import Purity, Category
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.columns')
+
+# NumPy is optional and slow to import, so it is only imported once columns
+# are first built
+np = None
+_np_imported = False
+
+
+def _numpy():
+    """The numpy module, imported on first call, None if it is not installed"""
+    global np, _np_imported
+    if not _np_imported:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            logger.debug('numpy is not installed, filters are checked row by row')
+        _np_imported = True
+    return np
+
+
+def _parse_resolution(resolution: Optional[str]) -> tuple[int, int]:
+    try:
+        width, height = resolution.split('x')
+        return int(width), int(height)
+    except (AttributeError, ValueError):
+        return -1, -1
+
+
+def _parse_mask(enum_cls, value: Optional[str]) -> int:
+    try:
+        return enum_cls[value.upper()].value
+    except (AttributeError, KeyError):
+        return 0
+
+
+class ColumnSnapshot:
+    """Columnar copy of the typed fields of a list of wallpapers
+
+    Every field is parsed once into a NumPy array, missing values become
+    nan / -1 / NaT, so a filter is a vectorized comparison over the whole
+    column giving a boolean mask, instead of calling the property getters of
+    each Wallpaper. Row i of every column belongs to the i-th wallpaper.
+    """
+
+    # Names of the columns, in the order of the values given by _row
+    FIELDS = ('ratio', 'file_size', 'width', 'height', 'purity', 'category', 'created')
+    DTYPES = ('float64', 'int64', 'int32', 'int32', 'uint8', 'uint8', 'datetime64[s]')
+
+    def __init__(self, ratio, file_size, width, height, purity, category, created):
+        self.ratio = ratio
+        self.file_size = file_size
+        self.width = width
+        self.height = height
+        self.purity = purity
+        self.category = category
+        self.created = created
+
+    def __len__(self):
+        return len(self.ratio)
+
+    @staticmethod
+    def _row(json: dict) -> tuple:
+        """Values of the columns for one wallpaper, created as a NumPy time string"""
+        width, height = _parse_resolution(json.get('resolution'))
+        return (json.get('ratio') or 'nan',
+                json.get('file_size') or -1,
+                width,
+                height,
+                _parse_mask(Purity, json.get('purity')),
+                _parse_mask(Category, json.get('category')),
+                # created_at is '%Y-%m-%d %H:%M:%S', NumPy wants a T in between
+                (json.get('created_at') or 'NaT').replace(' ', 'T', 1))
+
+    @classmethod
+    def from_json(cls, jsons: Iterable[dict]) -> 'ColumnSnapshot':
+        """Build the columns from the raw json of wallpapers, without materializing them"""
+
+        if _numpy() is None:
+            raise ImportError('numpy is required to build column snapshots')
+
+        columns = tuple(zip(*map(cls._row, jsons))) or ((), ) * len(cls.FIELDS)
+        arrays = {}
+        for field, dtype, values in zip(cls.FIELDS, cls.DTYPES, columns):
+            try:
+                arrays[field] = np.array(values, dtype=dtype)
+            except ValueError:
+                if field != 'created':
+                    raise
+                # Fall back to parse one by one so a malformed entry only loses itself
+                arrays[field] = np.array([cls._parse_created(x) for x in values], dtype=dtype)
+
+        return cls(**arrays)
+
+    @classmethod
+    def from_wallpapers(cls, wallpapers: Iterable[Wallpaper]) -> 'ColumnSnapshot':
+        return cls.from_json(wall.json for wall in wallpapers)
+
+    @staticmethod
+    def _parse_created(x: str):
+        try:
+            return np.datetime64(x, 's')
+        except ValueError:
+            logger.debug(f'Failed to parse created_at time string {x}')
+            return np.datetime64('NaT')
+
+    def take(self, indices) -> 'ColumnSnapshot':
+        """Snapshot of the given rows only, in the given order"""
+        return self.__class__(**{k: v[indices] for k, v in vars(self).items()})
+
+    def mask_ratio(self, ratio_min: float, ratio_max: float):
+        # Comparisons with nan are False, so missing ratios never match
+        return (self.ratio >= ratio_min) & (self.ratio <= ratio_max)
+
+    def mask_file_size(self, size_min: int, size_max: int):
+        return (self.file_size >= size_min) & (self.file_size <= size_max)
+
+    def mask_resolution(self, min_resolution: tuple[int, int], max_resolution: tuple[int, int]):
+        return ((self.width >= min_resolution[0]) & (self.width <= max_resolution[0])
+                & (self.height >= min_resolution[1]) & (self.height <= max_resolution[1]))
+
+    def mask_purity(self, purity: Purity):
+        return (self.purity & purity.value) != 0
+
+    def mask_category(self, category: Category):
+        return (self.category & category.value) != 0
+
+    def mask_created(self, after: dt.datetime, before: dt.datetime):
+        # Comparisons with NaT are False, so missing times never match
+        return (self.created >= np.datetime64(after, 's')) & (self.created <= np.datetime64(before, 's'))
+
+
+class CacheColumns:
+    """ColumnSnapshot of every wallpaper of a cache, kept up to date by add
+
+    Rows are appended for new ids and overwritten in place when the json of
+    an id changes, and the arrays grow by doubling, so the columns are built
+    once per cache and a filter only reads them.
+    """
+
+    def __init__(self):
+        if _numpy() is None:
+            raise ImportError('numpy is required to build column snapshots')
+
+        self._ids: list[str] = []
+        self._row_of: dict[str, int] = {}
+        self._columns = ColumnSnapshot.from_json([])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        """Replace the columns with the given (wallpaper id, json) pairs"""
+        items = list(items)
+        columns = ColumnSnapshot.from_json(json for _, json in items)
+        with self._lock:
+            self._ids = [wid for wid, _ in items]
+            self._row_of = {wid: i for i, wid in enumerate(self._ids)}
+            self._columns = columns
+        logger.debug(f'Built columns over {len(items)} cached wallpapers')
+
+    def _grow(self, size: int):
+        columns = self._columns
+        capacity = len(columns)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        arrays = {}
+        for field in ColumnSnapshot.FIELDS:
+            old = getattr(columns, field)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            arrays[field] = new
+        self._columns = ColumnSnapshot(**arrays)
+
+    def add(self, wid: str, json: dict):
+        """Insert or overwrite the row of the wallpaper"""
+        row = ColumnSnapshot._row(json)
+        with self._lock:
+            pos = self._row_of.get(wid)
+            if pos is None:
+                pos = len(self._ids)
+                self._grow(pos + 1)
+                self._ids.append(wid)
+                self._row_of[wid] = pos
+
+            columns = self._columns
+            for field, value in zip(ColumnSnapshot.FIELDS, row):
+                array = getattr(columns, field)
+                try:
+                    array[pos] = value
+                except ValueError:
+                    if field != 'created':
+                        raise
+                    array[pos] = ColumnSnapshot._parse_created(value)
+
+    def snapshot(self, ids: Optional[list[str]] = None) -> tuple[list[str], ColumnSnapshot]:
+        """Ids and columns of the given cached ids, of every cached id if None
+
+        Columns of every id are views into the kept arrays, otherwise only
+        the rows of the given ids are gathered. Ids without a row are left out.
+        """
+        with self._lock:
+            size = len(self._ids)
+            columns = ColumnSnapshot(**{field: getattr(self._columns, field)[:size]
+                                        for field in ColumnSnapshot.FIELDS})
+            if ids is None:
+                return self._ids[:size], columns
+
+            row_of = self._row_of
+            ids = [wid for wid in ids if wid in row_of]
+            rows = np.fromiter((row_of[wid] for wid in ids), dtype=np.int64, count=len(ids))
+        return ids, columns.take(rows)
@@ -3,37 +3,71 @@ import datetime as dt
 from typing import Optional
 
 from .enums import Purity, Category
-# from ..logger import MyLogger
+from ..logger import MyLogger
 
-# logger = MyLogger('data-fetch-utils.wallhaven')
+logger = MyLogger('data-fetch-utils.wallhaven.defs')
 
 class Tags:
 
+    __slots__ = ('tags', '_names')
+
     def __init__(self, tag_json_list):
 
         self.tags = {}
         for tag_json in tag_json_list:
             self.tags[tag_json['id']] = {k: v for k, v in tag_json.items() if k != 'id'}
 
+        # Normalized once so that a lookup is a set membership test
+        self._names = {self.normalize(tag['name']) for tag in self.tags.values() if 'name' in tag}
+
+    @staticmethod
+    def normalize(key: str | int) -> str | int:
+        """Tag id as int, or tag name in the form it is compared in
+
+        Only an int is an id, a str is always a name, even if numeric like 2077.
+        """
+        if isinstance(key, int):
+            return key
+        return key.strip().casefold()
+
     def __contains__(self, key: str | int):
 
-        if isinstance(key, int) or key.isnumeric():  # search in id
-            return int(key) in self.tags
+        key = self.normalize(key)
+        if isinstance(key, int):  # search in id
+            return key in self.tags
         else:
-            return any(key.upper() == tag['name'].upper() for tag in self.tags.values())
+            return key in self._names
 
     def __str__(self):
         # TODO - polish this part later
         return str(self.tags)
         
 
+# Slot not set, i.e. field absent from the json or typed field not parsed yet
+_MISSING = object()
+
+
 class Wallpaper:
+    """Wallpaper info from the API
+
+    The top level fields of the json are held in slots rather than in a
+    dict of their own, and the json the caches store is rebuilt from them
+    on demand. Typed fields are parsed on first access and kept until the
+    next update.
+    """
 
-    def __init__(self, json):
+    # Top level fields of the API json, any other one goes to _extra
+    FIELDS = ('id', 'url', 'short_url', 'uploader', 'views', 'favorites', 'source',
+              'purity', 'category', 'dimension_x', 'dimension_y', 'resolution', 'ratio',
+              'file_size', 'file_type', 'created_at', 'colors', 'path', 'thumbs', 'tags')
+    _SLOTS = {field: '_j_' + field for field in FIELDS}
+    _PARSED = ('_tags', '_resolution', '_ratio', '_file_size', '_purity', '_category', '_created')
 
-        self.json: dict = {}
-        self._tags = None
+    __slots__ = tuple(_SLOTS.values()) + ('_extra', ) + _PARSED
 
+    def __init__(self, json: dict):
+
+        self._extra: Optional[dict] = None
         self.update(json)
 
     def __str__(self):
@@ -44,80 +78,133 @@ class Wallpaper:
         return hash(self.id)
 
     def update(self, new_json: dict):
-        self.json.update(new_json)
+        slots = self._SLOTS
+        for key, value in new_json.items():
+            slot = slots.get(key)
+            if slot is not None:
+                setattr(self, slot, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+
+        for slot in self._PARSED:
+            setattr(self, slot, _MISSING)
 
-        if 'tags' in self.json:
-            self._tags = Tags(self.json['tags'])
+    @property
+    def json(self) -> dict:
+        """Json of the wallpaper, rebuilt on every access"""
+        ret = {}
+        for field, slot in self._SLOTS.items():
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                ret[field] = value
+        if self._extra:
+            ret.update(self._extra)
+        return ret
+
+    def get(self, key: str, default=None):
+        """Value of a json field, without rebuilding the json"""
+        slot = self._SLOTS.get(key)
+        if slot is not None:
+            value = getattr(self, slot, _MISSING)
+        else:
+            value = self._extra.get(key, _MISSING) if self._extra else _MISSING
+        return default if value is _MISSING else value
 
     def _get_and_convert(self, attr, transform_func=lambda x: x):
-        ret = self.json.get(attr)
+        ret = self.get(attr)
         if ret is None:
             return ret
-        else:
+
+        # A malformed field must not make the whole wallpaper unusable
+        try:
             return transform_func(ret)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.debug(f'Failed to parse {attr} value {ret}')
+            return None
+
+    def _parsed(self, slot: str, attr: str, transform_func):
+        ret = getattr(self, slot)
+        if ret is _MISSING:
+            ret = self._get_and_convert(attr, transform_func)
+            setattr(self, slot, ret)
+        return ret
 
     @property
     def tags(self) -> Optional[Tags]:
-        return self._tags
+        return self._parsed('_tags', 'tags', Tags)
 
     @property
     def id(self) -> str:
-        return self.json['id']
+        try:
+            return self._j_id
+        except AttributeError:
+            raise KeyError('id') from None
 
     @property
     def path(self) -> str:
-        return self.json['path']
+        ret = self.get('path', _MISSING)
+        if ret is _MISSING:
+            raise KeyError('path')
+        return ret
 
     @property
     def url(self) -> Optional[str]:
-        return self.json.get('url')
+        return self.get('url')
+
+    @staticmethod
+    def _parse_resolution(x):
+        width, height = x.split('x')
+        return int(width), int(height)
 
     @property
     def resolution(self) -> Optional[tuple[int, int]]:
-        return self._get_and_convert(
-            'resolution',
-            lambda x: tuple(map(int, x.slipt('x'))))
+        return self._parsed('_resolution', 'resolution', self._parse_resolution)
 
     @property
     def ratio(self) -> Optional[float]:
-        return self._get_and_convert('ratio', float)
+        return self._parsed('_ratio', 'ratio', float)
 
     @property
     def file_type(self) -> Optional[str]:
-        return self.json.get('file_type')
+        return self.get('file_type')
         
     @property
     def file_size(self) -> Optional[int]:
-        return self._get_and_convert('file_size', int)
+        return self._parsed('_file_size', 'file_size', int)
+
+    @staticmethod
+    def normalize_color(color: str) -> str:
+        """Hex color as lower case without #, e.g. 660000 for #660000"""
+        return color.strip().lstrip('#').lower()
+
+    @property
+    def colors(self) -> list[str]:
+        """Dominant colors given by the API, normalized"""
+        return [self.normalize_color(color) for color in self.get('colors') or []]
 
     @property
     def source(self) -> Optional[str]:
-        return self.json.get('source')
+        return self.get('source')
         
     @property
     def purity(self) -> Optional[Purity]:
-        return self._get_and_convert('purity', lambda x: Purity[x.upper()])
+        return self._parsed('_purity', 'purity', lambda x: Purity[x.upper()])
 
     @property
     def category(self) -> Optional[Category]:
-        return self._get_and_convert('category', lambda x: Category[x.upper()])
+        return self._parsed('_category', 'category', lambda x: Category[x.upper()])
 
     @staticmethod
     def _parse_time(x):
-        try:
-            ret = dt.datetime.strptime(x, '%Y-%m-%d %H:%M:%S')
-        except:
-            logging.debug(f'Failed to parse created_at time string {x}')
-            ret = None
-
-        return ret
+        return dt.datetime.strptime(x, '%Y-%m-%d %H:%M:%S')
         
     @property
     def created(self) -> Optional[dt.datetime]:
-        return self._get_and_convert('created_at', self._parse_time)
+        return self._parsed('_created', 'created_at', self._parse_time)
 
     @property
     def created_date(self) -> Optional[dt.date]:
         ret = self.created
         return ret if ret is None else ret.date()
-        
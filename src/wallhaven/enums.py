@@ -135,12 +135,16 @@ class DownloadStatus(Enum):
     SUCCEED = 0
     EXISTED = 1
     FAILED = 2
+    CORRUPT = 3
 
 class By(Enum):
 
     RATIO = 'ratio'
     FILE_SIZE = 'file_size'
+    RESOLUTION = 'resolution'
     PURITY = 'purity'
     CATEGORY = 'category'
     CREATED = "created"
     CREATED_DATE = "created_date"
+    TAG = "tag"
+    COLOR = "color"
@@ -1,34 +1,94 @@
 
+from __future__ import annotations
 import os
 import abc
 import json
+import itertools
+import contextlib
 import time
-from typing import Iterable, Optional
+import queue
+import threading
+from typing import Iterable, Iterator, Optional
 import requests
 from tqdm import tqdm
 
 from .defs import Wallpaper 
 from .enums import Purity, Category, Sorting, SortingOrder, TopRange, Color, DownloadStatus
 from .api import API
-from .cacher import Cache
-
-from ..exceptions import TooManyRequestsError, UnknownResponseError
+from .async_api import SyncAPIAdapter
+from .session import SessionPool
+from .ratelimit import get_rate_limiter, parse_retry_after, backoff_wait
+from .cacher import open_cache
+from .filter import Filter
+from .verify import StreamVerifier
+from .index import DownloadIndex
+from .store import ContentStore
+from .resolver import DetailResolver
+from .journal import RunJournal
+
+from ..exceptions import TooManyRequestsError, UnknownResponseError, CorruptDownloadError
 from ..logger import MyLogger
 
 logger = MyLogger('data-fetch-utils.wallhaven.fetcher')
 
+# Marker telling the workers of a pipeline stage that no more items will come
+_STOP = object()
+
 class Fetcher(abc.ABC):
 
-    last_download_time: float = time.time() 
+    # Number of newly fetched wallpaper details between two cache saves
+    CACHE_SAVE_EVERY = 200
+
+    # Suffix of files being downloaded, renamed to the final name once complete
+    PART_SUFFIX = '.part'
+
+    # Bounds of the adaptive download limiter
+    MAX_DOWNLOAD_SPEEDUP = 4
+    MAX_DOWNLOAD_CONCURRENCY = 8
+
+    # Whether wallpapers come with the search result json, so filters on its
+    # fields can be checked before fetching details
+    HAS_SEARCH_JSON = True
 
     def __init__(self,
                  fetch_wallpaper_details: bool = True,
                  download_file: bool = True,
                  base_dir: Optional[str] = None,
                  max_retries: int = 5,
-                 interval: int = 2):
-
-        self.cache = Cache()
+                 interval: int = 2,
+                 session: Optional[SessionPool] = None,
+                 burst: int = 1,
+                 shared_rate_limit: bool = False,
+                 api: Optional[API | SyncAPIAdapter] = None,
+                 rebuild_index: bool = False,
+                 verify_index: bool = False,
+                 store_dir: Optional[str] = None,
+                 store_link: str = 'hard',
+                 cache_backend: Optional[str] = None,
+                 predicate: Optional[Filter] = None,
+                 detail_workers: int = 4,
+                 resume: bool = False,
+                 adaptive: bool = False):
+        """
+        detail_workers: number of workers fetching wallpaper details, all
+            under the same rate limit
+        resume: continue the run interrupted last time, skipping the work
+            its journal records as done
+        adaptive: adjust request and download rates and concurrency to the
+            429 responses, starting from the ones learned by earlier runs
+        verify_index: stat the indexed file of a wallpaper before skipping its
+            download, in case files are removed without rebuilding the index
+        predicate: Filter whose filters wallpapers should pass to be fetched,
+            e.g. Filter([]).by(By.RATIO, 1.7, 1.8). Filters on search result
+            fields are checked before fetching details, the ones on tags after
+            fetching details, both before downloading
+        """
+
+        self.cache = open_cache(cache_backend)
+        # Load the cache while the first search requests are made
+        self.cache.preload()
+        self._cache_lock = threading.Lock()
+        self._num_unsaved = 0
 
         self.need_fetch_wallpaper_details = fetch_wallpaper_details
         self.need_download_file = download_file
@@ -36,7 +96,32 @@ class Fetcher(abc.ABC):
         self.max_retries: int = max_retries
         self.interval = interval
 
-        self.api = API(max_retries=max_retries, request_interval=interval)
+        # Share one pooled session between API calls and file downloads
+        if session is None:
+            session = api.session if api is not None else SessionPool()
+        self.session = session
+
+        # Limiters are shared by name, so that all fetchers in the process (or
+        # on the host with shared_rate_limit) draw from the same budget
+        # With adaptive, the request rate may grow up to the API limit and
+        # downloads up to MAX_DOWNLOAD_SPEEDUP times the interval based rate
+        self.adaptive = adaptive
+        self.rate_limiter = get_rate_limiter('api', API.request_rate(interval),
+                                             capacity=burst, shared=shared_rate_limit,
+                                             adaptive=adaptive, max_rate=API.MAX_REQUEST_RATE,
+                                             max_concurrency=detail_workers)
+        self.download_limiter = (get_rate_limiter('download', 1 / interval,
+                                                  capacity=burst, shared=shared_rate_limit,
+                                                  adaptive=adaptive,
+                                                  max_rate=self.MAX_DOWNLOAD_SPEEDUP / interval,
+                                                  max_concurrency=self.MAX_DOWNLOAD_CONCURRENCY)
+                                 if interval > 0 else None)
+
+        # An AsyncAPI can be plugged in through SyncAPIAdapter
+        self.api = api if api is not None else API(max_retries=max_retries,
+                                                   request_interval=interval,
+                                                   session=self.session,
+                                                   rate_limiter=self.rate_limiter)
 
         logger.info("Fetcher initialize setup")
         logger.info(f'Need to fetch wallpaper details: {self.need_fetch_wallpaper_details}')
@@ -44,102 +129,344 @@ class Fetcher(abc.ABC):
         logger.info(f'Base dir to save wallpaper: {self.base_dir}')
         logger.info(f'Max retries: {self.max_retries}')
         logger.info(f'Request interval {self.interval}')
+        logger.info(f'Rate limit burst {burst} (shared across processes: {shared_rate_limit})')
+        logger.info(f'Adaptive rate limit: {adaptive}')
+
+        self.detail_workers = detail_workers
+        self.resolver = DetailResolver(api=self.api, cache=self.cache, workers=detail_workers,
+                                       cache_lock=self._cache_lock)
+
+        # Journal of the progress of a run, opened when the run starts
+        self.resume = resume
+        self.journal: Optional[RunJournal] = None
+        logger.info(f'Resume interrupted run: {resume}')
+
+        self.predicate = predicate
+        if predicate is not None and predicate.needs_details and not self.need_fetch_wallpaper_details:
+            logger.info('Predicate filters on wallpaper details, details will be fetched')
+            self.need_fetch_wallpaper_details = True
+
+        # Optional content-addressed store that downloaded files are linked into
+        self.store = ContentStore(store_dir, link=store_link) if store_dir is not None else None
+        logger.info(f'Content store: {self.store.root if self.store else None}')
+
+        # Download index is only built or loaded when first needed
+        self._index: Optional[DownloadIndex] = None
+        self._index_lock = threading.Lock()
+        self._rebuild_index = rebuild_index
+        self._verify_index = verify_index
+
+    @property
+    def index(self) -> DownloadIndex:
+        with self._index_lock:
+            if self._index is None:
+                self._index = DownloadIndex(self.base_dir, rebuild=self._rebuild_index,
+                                            verify=self._verify_index)
+            return self._index
 
     def download(self, wallpaper: Wallpaper, **kwargs) -> DownloadStatus:
 
         save_path = self._get_save_path(wallpaper)
         status = DownloadStatus.FAILED
-        if os.path.isfile(save_path):
-            logger.info(f"Wallpaper {wallpaper.id} has existing file {save_path}")
+        if self.journal is not None and self.journal.done(wallpaper.id, 'verified'):
+            logger.info(f"Wallpaper {wallpaper.id} was downloaded before the run was interrupted")
+            status = DownloadStatus.EXISTED
+        elif (entry := self.index.lookup(wallpaper.id)) is not None:
+            logger.info(f"Wallpaper {wallpaper.id} has existing file {entry.path}")
+            self._record(wallpaper.id, 'verified')
             status = DownloadStatus.EXISTED
         else:
             retry = 0
             while retry < self.max_retries:
                 try:
-                    self._download(wallpaper.path, save_path, **kwargs)
+                    with (self.download_limiter.slot() if self.download_limiter is not None
+                          else contextlib.nullcontext()):
+                        digest = self._download(wallpaper.path, save_path,
+                                                total_size=wallpaper.file_size,
+                                                file_type=wallpaper.file_type,
+                                                **kwargs)
                 except TooManyRequestsError as e:
-                    logger.debug("Encountered 429 error when downloading")
-                    time.sleep(5)
+                    retry += 1
+                    wait = backoff_wait(retry, e.retry_after, base=API.RETRY_WAIT)
+                    logger.debug(f"Encountered 429 error when downloading, waiting {wait:.1f}s to retry")
+                    time.sleep(wait)
+                except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                    # The partial file is kept, so the retry resumes from where it stopped
+                    logger.warning(f"Connection dropped when downloading {wallpaper.id}, retrying",
+                                   exc_info=e)
+                    retry += 1
+                except CorruptDownloadError as e:
+                    logger.error(f"Corrupt download of {wallpaper.id} from {wallpaper.path}: {e}")
+                    status = DownloadStatus.CORRUPT
+                    break
                 except Exception as e:
                     logger.error(f"Encounter error when downloading {wallpaper.id} from {wallpaper.path}",
                                 exc_info=e)
                     break
                 else:
+                    if digest is None:
+                        # The stream ended early, the retry resumes from the partial file
+                        retry += 1
+                        logger.warning(f"Download of {wallpaper.id} is incomplete, partial file is kept"
+                                       f" and resumed ({retry}/{self.max_retries})")
+                        continue
                     logger.info(f"Wallpaper {wallpaper.id} successfully downloaded to {save_path}")
+                    logger.debug(f"Wallpaper {wallpaper.id} has {StreamVerifier.HASH_ALGORITHM} {digest}")
+                    self._record(wallpaper.id, 'downloaded')
+                    if self.store is not None:
+                        try:
+                            if self.store.put(save_path, digest):
+                                logger.info(f"Wallpaper {wallpaper.id} is a duplicate, linked to stored content")
+                        except Exception as e:
+                            # File is downloaded and verified, only its deduplication failed
+                            logger.warning(f"Cannot store {save_path} in {self.store.root}, keep the file",
+                                           exc_info=e)
+                    self.index.add(wallpaper.id, save_path, hash=digest)
+                    self._record(wallpaper.id, 'verified', {'hash': digest})
                     status = DownloadStatus.SUCCEED
                     break
 
         return status
 
-    def _download(self, url, save_path, no_progress: bool = True, total_size=None) -> bool:
+    def _download(self, url, save_path, no_progress: bool = True,
+                  total_size: Optional[int] = None, file_type: Optional[str] = None) -> Optional[str]:
+        """Download url to save_path through a partial file
+
+        Content is written to save_path + PART_SUFFIX, which is renamed to
+        save_path only once complete and verified. If a partial file is left
+        by an earlier attempt, the download resumes from its length with a
+        Range request, and only the partial file is read back to be hashed.
+
+        total_size: expected file size, e.g. Wallpaper.file_size
+        file_type: expected MIME type, e.g. Wallpaper.file_type
+
+        Return the hex digest of the file, or None if the stream ended early
+        and the partial file is kept. Raise CorruptDownloadError if the
+        content does not match what is expected, the partial file is removed.
+        """
+
+        if self.download_limiter is not None:
+            self.download_limiter.acquire()
+
+        part_path = save_path + self.PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+        r = self.session.get(url, stream=True, headers=headers)
+        # Closed however it ends, so the connection goes back to the pool
+        try:
+            if offset > 0 and r.status_code == 416:
+                # Partial file is not consistent with the remote one, start over
+                logger.debug(f'Range not satisfiable for {part_path}, restart downloading')
+                r.close()
+                os.remove(part_path)
+                offset = 0
+                r = self.session.get(url, stream=True)
+
+            if r.status_code == 429:
+                e = TooManyRequestsError(retry_after=parse_retry_after(r.headers.get('Retry-After')))
+                if self.download_limiter is not None:
+                    self.download_limiter.on_throttled(e.retry_after)
+                raise e
+            elif r.status_code == 200:
+                # Server may ignore the Range header and send the whole content
+                offset = 0
+            elif r.status_code != 206 or offset == 0:
+                raise UnknownResponseError(r)
+
+            if offset > 0:
+                logger.debug(f'Resuming download of {url} from byte {offset}')
+
+            content_length = r.headers.get('content-length')
+            content_length = offset + int(content_length) if content_length is not None else None
+            chunk_size = 32 * 1024
+
+            verifier = StreamVerifier(expected_size=total_size, file_type=file_type)
+            if offset > 0:
+                with open(part_path, 'rb') as f:
+                    while chunk := f.read(chunk_size):
+                        verifier.update(chunk)
+
+            dirname = os.path.dirname(save_path)
+            if not os.path.isdir(dirname):
+                logger.debug(f'Making directory {dirname}')
+                os.makedirs(dirname, exist_ok=True)
+
+            with tqdm(total=content_length, initial=offset, unit='B', unit_scale=True, miniters=1,
+                      disable=no_progress) as bar:
+                with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size):
+
+                        bar.update(len(chunk))
+                        verifier.update(chunk)
+                        f.write(chunk)
+        finally:
+            r.close()
+
+        if content_length is not None and verifier.size < content_length:
+            logger.warning(f'Downloaded {verifier.size} of {content_length} bytes from {url}, keep partial file')
+            return None
+
+        try:
+            digest = verifier.verify(content_length)
+        except CorruptDownloadError:
+            os.remove(part_path)
+            raise
+
+        os.replace(part_path, save_path)
+        if self.download_limiter is not None:
+            self.download_limiter.on_success()
+        return digest
 
-        while time.time() - self.last_download_time < self.interval:
-            time.sleep(.5)
-        
-        r = requests.get(url, stream=True)
-        
-        if r.status_code == 429:
-            raise TooManyRequestsError
-        elif r.status_code != 200:
-            raise UnknownResponseError(r)
-        
-        total_size = int(r.headers.get('content-length', 0))
-        chunk_size = 32 * 1024
+    @abc.abstractmethod
+    def get_wallpapers(self) -> list[Wallpaper]:
+        """Return a list of wallpaper instance to be downloaded"""
 
-        dirname = os.path.dirname(save_path)
-        if not os.path.isdir(dirname):
-            logger.debug(f'Making directory {dirname}')
-            os.makedirs(dirname)
+    def iter_wallpapers(self) -> Iterator[Wallpaper]:
+        """Yield wallpaper instances to be downloaded, lazily if supported"""
+        yield from self.get_wallpapers()
+
+    def _run_params(self) -> dict:
+        """Parameters deciding the work of the run, a journal is only resumed by the same ones"""
+        return {'base_dir': os.path.abspath(self.base_dir),
+                'details': self.need_fetch_wallpaper_details,
+                'download': self.need_download_file,
+                'predicate': self.predicate.fingerprint if self.predicate is not None else None}
+
+    def _open_journal(self):
+        self.journal = RunJournal(self.__class__.__name__.lower(), resume=self.resume,
+                                  params=self._run_params())
+
+        # Details fetched before the interruption may not have been saved
+        num_restored = 0
+        for data in self.journal.details():
+            if data['id'] not in self.cache:
+                self.cache.add(Wallpaper(data))
+                num_restored += 1
+        if num_restored > 0:
+            logger.info(f'Restored {num_restored} wallpaper details from the journal')
+            self._save_cache()
+
+    def _save_limiters(self):
+        # Rates learned by adaptive limiters are where the next run starts
+        for limiter in (self.rate_limiter, self.download_limiter):
+            if limiter is not None:
+                limiter.save()
+
+    def _close_journal(self):
+        # Once the run went through, nothing is left to resume
+        if self.journal is not None:
+            self.journal.close(remove=self.journal.listing_done)
+            self.journal = None
+
+    def _record(self, wid: str, stage: str, data: Optional[dict] = None):
+        if self.journal is not None and not self.journal.done(wid, stage):
+            self.journal.record(wid, stage, data)
+
+    def _listed(self) -> Iterator[Wallpaper]:
+        """Wallpapers of the run, taken from the journal if listed completely before"""
+
+        if self.journal is not None and self.journal.listing_done:
+            logger.info('Listing was done before the run was interrupted, skip searching')
+            for data in self.journal.listed():
+                yield Wallpaper(data)
+            return
+
+        for wall in self.iter_wallpapers():
+            # Details may be recorded first, e.g. by QueryFetcher, the listing
+            # is still needed to replay it. Without search json, the id is
+            # all there is to replay
+            if self.journal is not None and not self.journal.is_listed(wall.id):
+                self.journal.record(wall.id, 'listed', wall.json if self.HAS_SEARCH_JSON else None)
+            yield wall
+
+        if self.journal is not None:
+            self.journal.mark_listing_done()
+
+    def _is_wanted(self, wallpaper: Wallpaper, detailed: bool) -> bool:
+        """Whether the wallpaper passes the predicate as far as it can be checked
+
+        detailed: whether the details of the wallpaper are fetched
+        """
+        if self.predicate is None:
+            return True
+
+        if detailed:
+            fields = Filter.DETAIL_FIELDS if self.HAS_SEARCH_JSON else None
+        elif self.HAS_SEARCH_JSON:
+            fields = Filter.SEARCH_FIELDS
+        else:
+            return True
 
-        wrote = 0
-        with tqdm(total=total_size, unit='B', unit_scale=True, miniters=1, disable=no_progress) as bar:
-            with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size):
+        if self.predicate.matches(wallpaper, fields):
+            return True
 
-                    bar.update(len(chunk))
-                    wrote += int(len(chunk))
-                    f.write(chunk)
-        r.close()
-        self.last_download_time = time.time()
+        logger.debug(f'Wallpaper {wallpaper.id} filtered out {"after" if detailed else "before"} fetching details')
+        return False
 
-        return wrote == total_size
-
-    @abc.abstractmethod
-    def get_wallpapers(self) -> list[Wallpaper]:
-        """Return a list of wallpaper instance to be downloaded"""
+    def _is_known(self, wallpaper: Wallpaper) -> bool:
+        """Whether the wallpaper is already cached or downloaded"""
+        return wallpaper.id in self.cache or wallpaper.id in self.index
 
     def fetch_wallpaper_details(self, wallpapers: list[Wallpaper]):
-        
-        save_cnt = 0
-        for wall in tqdm(wallpapers, desc="Updating wallpaper details"):
 
-            if wall.id in self.cache:
-                logger.info(f'Wallpaper details for {wall.id} existed in cache')
-                wall.update(self.cache[wall.id])
+        # Details are looked up in one batch, concurrently for uncached ones
+        resolved = self.resolver.resolve(wall.id for wall in wallpapers)
+
+        for wall in wallpapers:
+            if (detailed := resolved.get(wall.id)) is not None:
+                wall.update(detailed.json)
+                # Details only need a copy in the journal if the cache may lose them
+                self._record(wall.id, 'detailed', None if self.cache.DURABLE_ADD else detailed.json)
             else:
-                try:
-                    logger.info(f'Fetching details for {wall.id}')
-                    r = self.api.get_wallpaper_info(wid=wall.id)
-                except UnknownResponseError as e:
-                    logger.warning("Encountered unknown response error when fetching details for wallpaper",
-                                   exc_info=e)
+                with self._cache_lock:
+                    # Keep the count of failed lookups the resolver cached
+                    wall.update(self.cache.get(wall.id) or {})
                     wall.update({'path': 'ERROR'})
-                else:
-                    json = r.json()
-                    if "error" in json:
-                        logger.warning(f"Encountered error when fetching details for wallpaper {wall.id}")
-                        wall.update({'path': 'ERROR'})
-                    else:
-                        wall.update(json['data'])
+                    self.cache.add(wall)
 
-                self.cache.add(wall)
+        self._save_cache()
 
-                save_cnt += 1
-                if save_cnt == 200:
-                    self.cache.save()
-                    save_cnt = 0
+    def _fetch_wallpaper_detail(self, wall: Wallpaper):
 
-        self.cache.save()
+        if wall.id in self.cache:
+            logger.info(f'Wallpaper details for {wall.id} existed in cache')
+            wall.update(self.cache[wall.id])
+            return
+
+        try:
+            logger.info(f'Fetching details for {wall.id}')
+            r = self.api.get_wallpaper_info(wid=wall.id)
+        except UnknownResponseError as e:
+            logger.warning("Encountered unknown response error when fetching details for wallpaper",
+                           exc_info=e)
+            wall.update({'path': 'ERROR'})
+        else:
+            json = r.json()
+            if "error" in json:
+                logger.warning(f"Encountered error when fetching details for wallpaper {wall.id}")
+                wall.update({'path': 'ERROR'})
+            else:
+                wall.update(json['data'])
+                self._record(wall.id, 'detailed', None if self.cache.DURABLE_ADD else wall.json)
+
+        with self._cache_lock:
+            self.cache.add(wall)
+
+            self._num_unsaved += 1
+            if self._num_unsaved >= self.CACHE_SAVE_EVERY:
+                self.cache.save()
+                self._num_unsaved = 0
+
+    def _save_cache(self):
+        with self._cache_lock:
+            self.cache.save()
+            self._num_unsaved = 0
+
+    def _save_index(self):
+        # Downloads are journaled as they happen, only fold them in if loaded
+        if self._index is not None:
+            self._index.save()
 
     def _get_save_path(self, wallpaper: Wallpaper) -> str:
         
@@ -151,10 +478,15 @@ class Fetcher(abc.ABC):
 
     def run(self):
 
-        wallpapers = self.get_wallpapers()
+        self._open_journal()
+
+        wallpapers = list(self._listed())
+        logger.info(f"Found {len(wallpapers)} wallpapers in total.")
+        wallpapers = [wall for wall in wallpapers if self._is_wanted(wall, detailed=False)]
 
         if self.need_fetch_wallpaper_details:
             self.fetch_wallpaper_details(wallpapers)
+            wallpapers = [wall for wall in wallpapers if self._is_wanted(wall, detailed=True)]
 
         if self.need_download_file:
             download_status = {}
@@ -163,20 +495,115 @@ class Fetcher(abc.ABC):
 
             self._report_download_status(download_status)
 
+        self._save_index()
+        self._close_journal()
+        self._save_limiters()
+        self.session.log_stats()
+
+    def run_pipelined(self,
+                      detail_workers: Optional[int] = None,
+                      download_workers: int = 2,
+                      queue_size: int = 48):
+        """Run search, detail fetching and downloading as overlapping stages
+
+        Wallpapers found by iter_wallpapers are passed through bounded queues
+        to a pool of detail fetching workers and then to a pool of download
+        workers, so each stage starts as soon as the first item is available
+        and the total time approaches the one of the slowest stage.
+        """
+
+        if detail_workers is None:
+            detail_workers = self.detail_workers
+
+        self._open_journal()
+
+        detail_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        download_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        download_status: dict[Wallpaper, DownloadStatus] = {}
+        num_found = 0
+
+        def search():
+            nonlocal num_found
+            try:
+                for wall in self._listed():
+                    num_found += 1
+                    if self._is_wanted(wall, detailed=False):
+                        detail_queue.put(wall)
+            except Exception as e:
+                logger.error("Encountered error when searching wallpapers, stop searching", exc_info=e)
+
+        def fetch_details():
+            while (wall := detail_queue.get()) is not _STOP:
+                if self.need_fetch_wallpaper_details:
+                    try:
+                        self._fetch_wallpaper_detail(wall)
+                    except Exception as e:
+                        logger.error(f"Encountered error when fetching details for {wall.id}", exc_info=e)
+                        continue
+
+                    if not self._is_wanted(wall, detailed=True):
+                        continue
+
+                if self.need_download_file:
+                    download_queue.put(wall)
+
+        def download():
+            # A dead worker would leave the detail stage blocked on the full
+            # queue, so the worker outlives any error and keeps draining it
+            while (wall := download_queue.get()) is not _STOP:
+                try:
+                    download_status[wall] = self.download(wall)
+                except Exception as e:
+                    logger.error(f"Encountered error when downloading {wall.id}", exc_info=e)
+                    download_status[wall] = DownloadStatus.FAILED
+
+        # Stages are closed in order: once all workers of a stage are done,
+        # each worker of the next stage receives a stop marker
+        stages = [(search, 1, detail_queue),
+                  (fetch_details, detail_workers, download_queue),
+                  (download, download_workers, None)]
+        threads = [[threading.Thread(target=target, name=f'wallhaven-{target.__name__}-{i}', daemon=True)
+                    for i in range(num_workers)]
+                   for target, num_workers, _ in stages]
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        for (_, _, out_queue), stage_threads, next_threads in zip(stages, threads, threads[1:] + [[]]):
+            for thread in stage_threads:
+                thread.join()
+            for _ in next_threads:
+                out_queue.put(_STOP)
+
+        logger.info(f"Found {num_found} wallpapers in total.")
+        self._save_cache()
+
+        if self.need_download_file:
+            self._report_download_status(download_status)
+
+        self._save_index()
+        self._close_journal()
+        self._save_limiters()
+        self.session.log_stats()
+
     @staticmethod
     def _report_download_status(download_status: dict[Wallpaper, DownloadStatus]):
         num_success = sum(1 if v is DownloadStatus.SUCCEED else 0
                           for v in download_status.values())
         num_existed = sum(1 if v is DownloadStatus.EXISTED else 0
                           for v in download_status.values())
-        num_failed = len(download_status) - num_existed - num_success
+        num_corrupt = sum(1 if v is DownloadStatus.CORRUPT else 0
+                          for v in download_status.values())
+        num_failed = len(download_status) - num_existed - num_success - num_corrupt
 
-        logger.info(f"Download summary: {num_success} / {num_existed} / {num_failed}"
-                    " (success / existed / failed)")
-        if num_failed > 0:
+        logger.info(f"Download summary: {num_success} / {num_existed} / {num_corrupt} / {num_failed}"
+                    " (success / existed / corrupt / failed)")
+        if num_failed + num_corrupt > 0:
             for wall, status in download_status.items():
                 if status is DownloadStatus.FAILED:
                     logger.info(f"Failed to download for wallpaper {wall.id} @ {wall.path}")
+                elif status is DownloadStatus.CORRUPT:
+                    logger.info(f"Corrupt download for wallpaper {wall.id} @ {wall.path}")
         
 
 class DailyFetcher(Fetcher):
@@ -190,37 +617,66 @@ class DailyFetcher(Fetcher):
                  interval: int = 2,
                  page_range: Iterable[int] = range(1, 50+1),
                  purities: Purity = Purity.SFW + Purity.SKETCHY,
-                 categories: Category = Category.ALL):
+                 categories: Category = Category.ALL,
+                 stop_after_known: Optional[int] = None,
+                 **kwargs):
+        """
+        stop_after_known: stop searching once this many consecutive wallpapers
+            are already cached or downloaded, if None, search all pages. Only
+            the wallpapers kept by the predicate are counted
 
+        Extra keyword arguments, e.g. session or burst, are passed to Fetcher
+        """
 
         super().__init__(
             fetch_wallpaper_details=fetch_wallpaper_details,
             download_file=download_file,
             base_dir=base_dir,
             max_retries=max_retries,
-            interval=interval)
+            interval=interval,
+            **kwargs)
 
         self.page_range: Iterable[int] = page_range
         self.purities: Purity = purities
         self.categories: Category = categories
+        self.stop_after_known: Optional[int] = stop_after_known
+
+    def _run_params(self) -> dict:
+        return {**super()._run_params(),
+                'pages': str(self.page_range),
+                'purities': self.purities.value,
+                'categories': self.categories.value,
+                'stop_after_known': self.stop_after_known}
+
+    def iter_wallpapers(self) -> Iterator[Wallpaper]:
+        # Pages are only requested when the previous one has been consumed, so
+        # stopping early saves all the remaining search requests
+        wallpapers = self.api.iter_search(
+            pages=self.page_range,
+            purity=self.purities,
+            categories=self.categories,
+            sorting=Sorting.DATE_ADDED
+        )
+
+        num_known = 0
+        for wallpaper in wallpapers:
+            # Rejected wallpapers are never cached, so they would look new on
+            # every run, they neither count as known nor break the streak
+            if not self._is_wanted(wallpaper, detailed=False):
+                continue
+
+            if self._is_known(wallpaper):
+                num_known += 1
+                if self.stop_after_known is not None and num_known >= self.stop_after_known:
+                    logger.info(f"Seen {num_known} consecutive known wallpapers, stop searching")
+                    return
+            else:
+                num_known = 0
+
+            yield wallpaper
 
     def get_wallpapers(self) -> list[Wallpaper]:
-        ret = []
-        for page in self.page_range:
-            logger.info(f"Searching wallpapers on page {page}")
-            r = self.api.search(
-                purity=self.purities,
-                categories=self.categories,
-                sorting=Sorting.DATE_ADDED,
-                page=page
-            )
-
-            json_data = r.json()['data']
-
-            logger.info(f"Found {len(json_data)} wallpapers on page {page}")
-            for json in json_data:
-                ret.append(Wallpaper(json))
-        
+        ret = list(self.iter_wallpapers())
         logger.info(f"Found {len(ret)} wallpapers in total.")
 
         return ret
@@ -229,19 +685,28 @@ class DailyFetcher(Fetcher):
 class IDFetcher(Fetcher):
     """Fetch wall from given Ids"""
 
+    # Only ids are known until the details are fetched
+    HAS_SEARCH_JSON = False
+
     def __init__(self,
                  wall_ids: list[str],
                  download_file: bool = True,
                  base_dir: Optional[str] = None,
                  max_retries: int = 5,
-                 interval: int = 2):
+                 interval: int = 2,
+                 **kwargs):
         super().__init__(fetch_wallpaper_details=True,
                          download_file=download_file,
                          base_dir=base_dir,
                          max_retries=max_retries,
-                         interval=interval)
-        self.wall_ids = wall_ids
-        logger.info(f'Loaded {len(wall_ids)} wallpaper ids')
+                         interval=interval,
+                         **kwargs)
+        # Ids may come with the newline of the line they were read from
+        self.wall_ids = DetailResolver.normalize_ids(wall_ids)
+        logger.info(f'Loaded {len(self.wall_ids)} wallpaper ids ({len(wall_ids)} given)')
+
+    def _run_params(self) -> dict:
+        return {**super()._run_params(), 'wall_ids': self.wall_ids}
 
     def _create_empty_wallpaper(self, wall_id):
         return Wallpaper({'id': wall_id})
@@ -251,6 +716,48 @@ class IDFetcher(Fetcher):
 
 
 class QueryFetcher(Fetcher):
+    """Fetch the results of a search query, streaming them page by page
+
+    Results are passed on to detail fetching and downloading as each page
+    arrives, and paging stops as soon as max_results or max_bytes is met,
+    e.g. QueryFetcher(max_results=100).query(q='landscape').run()
+
+    Only wallpapers passing the predicate count toward the limits. If it
+    filters on details, e.g. tags, details are fetched while searching, in
+    batches of detail_workers, so that the limits are checked after it.
+    """
+
+    def __init__(self,
+                 fetch_wallpaper_details: bool = True,
+                 download_file: bool = True,
+                 base_dir: Optional[str] = None,
+                 max_retries: int = 5,
+                 interval: int = 2,
+                 max_results: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 **kwargs):
+        """
+        max_results: stop after this many wanted wallpapers, if None, no limit
+        max_bytes: stop before the file sizes of the wanted wallpapers not
+            yet downloaded add up to more than this, if None, no limit
+
+        Extra keyword arguments, e.g. session or predicate, are passed to Fetcher
+        """
+
+        super().__init__(
+            fetch_wallpaper_details=fetch_wallpaper_details,
+            download_file=download_file,
+            base_dir=base_dir,
+            max_retries=max_retries,
+            interval=interval,
+            **kwargs)
+
+        self.max_results: Optional[int] = max_results
+        self.max_bytes: Optional[int] = max_bytes
+        self.search_params: dict = {}
+        self.start_page: int = 1
+
+        logger.info(f'Max results: {max_results}, max bytes: {max_bytes}')
 
     def query(
             self,
@@ -264,10 +771,91 @@ class QueryFetcher(Fetcher):
             resolutions: Optional[list[str]] = None,
             ratios: Optional[list[str]] = None,
             colors: Optional[Color] = None,
-            page: Optional[str] = None,
-            seed: Optional[str] = None):
-        pass
+            page: Optional[int] = None,
+            seed: Optional[str] = None) -> QueryFetcher:
+        """Set the search query, arguments are the same as API.search
+
+        page: page to start from, later pages follow until a limit is met
+        seed: seed of a random sorting, later pages reuse the returned one
+
+        Return the fetcher itself, so run can be chained.
+        """
+
+        # Fail early on invalid combinations rather than on the first request
+        API._search_params(q=q, categories=categories, purity=purity, sorting=sorting,
+                           order=order, top_range=top_range, atleast=atleast,
+                           resolutions=resolutions, ratios=ratios, colors=colors, seed=seed)
+
+        self.search_params = dict(q=q, categories=categories, purity=purity, sorting=sorting,
+                                  order=order, top_range=top_range, atleast=atleast,
+                                  resolutions=resolutions, ratios=ratios, colors=colors, seed=seed)
+        self.start_page = page if page is not None else 1
+        logger.info(f'Query: {API._search_params(**self.search_params)}, starting from page {self.start_page}')
+
+        return self
+
+    def _run_params(self) -> dict:
+        return {**super()._run_params(),
+                'query': API._search_params(**self.search_params),
+                'start_page': self.start_page,
+                'max_results': self.max_results,
+                'max_bytes': self.max_bytes}
+
+    def iter_wallpapers(self) -> Iterator[Wallpaper]:
+        # The page iterator only requests a page once the previous one is
+        # consumed, so returning here saves all the remaining pages
+        wallpapers = self.api.iter_search(pages=itertools.count(self.start_page), **self.search_params)
+
+        num_results = 0
+        num_bytes = 0
+        for wallpaper in self._iter_wanted(wallpapers):
+            if self.max_bytes is not None and wallpaper.id not in self.index:
+                if num_bytes + (wallpaper.file_size or 0) > self.max_bytes:
+                    logger.info(f"Reached byte budget {self.max_bytes} with {num_bytes} bytes, stop searching")
+                    return
+                num_bytes += wallpaper.file_size or 0
+
+            yield wallpaper
+
+            num_results += 1
+            if self.max_results is not None and num_results >= self.max_results:
+                logger.info(f"Reached {num_results} results, stop searching")
+                return
+
+    def _iter_wanted(self, wallpapers: Iterator[Wallpaper]) -> Iterator[Wallpaper]:
+        """Wallpapers passing the predicate, with details fetched if it needs them"""
+
+        if self.predicate is None or not self.predicate.needs_details:
+            yield from (wall for wall in wallpapers if self._is_wanted(wall, detailed=False))
+            return
+
+        batch = []
+        for wallpaper in wallpapers:
+            if self._is_wanted(wallpaper, detailed=False):
+                batch.append(wallpaper)
+            if len(batch) >= self.detail_workers:
+                yield from self._with_details(batch)
+                batch = []
+        yield from self._with_details(batch)
+
+    def _with_details(self, wallpapers: list[Wallpaper]) -> Iterator[Wallpaper]:
+        # The cache is saved at the end of the run, the journal has the
+        # details in the meantime. The detail stage then finds them cached
+        resolved = self.resolver.resolve((wall.id for wall in wallpapers), save=False)
+        for wall in wallpapers:
+            if (detailed := resolved.get(wall.id)) is None:
+                continue
+            wall.update(detailed.json)
+            self._record(wall.id, 'detailed', None if self.cache.DURABLE_ADD else detailed.json)
+            if self._is_wanted(wall, detailed=True):
+                yield wall
 
-    # def _get_wallpape1rs(self)
+    def get_wallpapers(self) -> list[Wallpaper]:
+        ret = list(self.iter_wallpapers())
+        logger.info(f"Found {len(ret)} wallpapers in total.")
 
+        return ret
 
+    def run(self, detail_workers: Optional[int] = None, download_workers: int = 2):
+        """Stream results into detail fetching and downloading, see run_pipelined"""
+        self.run_pipelined(detail_workers=detail_workers, download_workers=download_workers)
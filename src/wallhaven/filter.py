@@ -1,107 +1,557 @@
-
 from __future__ import annotations
+import json
+import threading
 import datetime as dt
-from typing import Iterable, Iterator, Optional
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, Optional
 
-from .defs import Wallpaper 
-from .enums import By, Purity, Category
-from .cacher import Cache
+from .defs import Wallpaper, Tags
+from .enums import By, Purity, Category, Color
+from .cacher import BaseCache, open_cache
+from .columns import ColumnSnapshot, _numpy
+from .resolver import DetailResolver
 
 from ..utils import rectify_date
 from ..logger import MyLogger
 
 logger = MyLogger('data-fetch-utils.wallhaven.filter')
 
+# A filter normalized into (By, bounds), bounds being hashable
+Predicate = tuple[By, object]
+
 class Filter:
-    """Apply filter by meta data using saved meta info"""
+    """Apply filter by meta data using saved meta info
+
+    Chained by calls only record the filters, which are run together when
+    the result is first needed, i.e. iterated, indexed or its len taken:
+
+    - over the whole cache, the most selective indexed filter gives the
+      candidate ids with a bisect, and tag filters intersect them through
+      the tag index
+    - the other filters are then fused into one pass over the candidates,
+      most selective first: vectorized masks over the columns the cache
+      keeps up to date if numpy is available, otherwise one row-by-row check
+
+    Results over the whole cache are memoized by their normalized filters,
+    so asking the same question again is a lookup until the cache changes.
+    They are kept as ids, each wallpaper is only materialized through the
+    cache LRU when iterated or indexed, so memory stays bounded by the LRU.
+    """
+
+    # Guessed share of wallpapers kept by a filter, when no index tells better
+    DEFAULT_SELECTIVITY = {
+        By.RATIO: 0.3,
+        By.FILE_SIZE: 0.5,
+        By.RESOLUTION: 0.3,
+        By.PURITY: 0.5,
+        By.CATEGORY: 0.5,
+        By.CREATED: 0.2,
+        By.TAG: 0.05,
+        By.COLOR: 0.1,
+    }
 
-    def __init__(self, wallpapers: Optional[Iterable[Wallpaper | str] | Iterator[Wallpaper | str]] = None):
+    # Filters without a columnar form, always checked row by row
+    ROW_ONLY = frozenset({By.TAG, By.COLOR})
+
+    # Filters on fields already in the search results, and the ones needing
+    # the wallpaper details, see matches
+    SEARCH_FIELDS = frozenset({By.RATIO, By.FILE_SIZE, By.RESOLUTION, By.PURITY,
+                               By.CATEGORY, By.CREATED, By.COLOR})
+    DETAIL_FIELDS = frozenset({By.TAG})
+
+    # (cache identity, filters) -> (cache generation, ids of the result)
+    MEMO_SIZE = 64
+    _memo: OrderedDict[tuple, tuple[int, list[str]]] = OrderedDict()
+    _memo_lock = threading.Lock()
+
+    def __init__(self,
+                 wallpapers: Optional[Iterable[Wallpaper | str] | Iterator[Wallpaper | str]] = None,
+                 cache: Optional[BaseCache] = None,
+                 resolver: Optional[DetailResolver] = None):
         """
         wallpapers: list of Wallpaper instances or wallpaper_id, if None, will use all entries from cache file
+        cache: cache to look up wallpaper ids from, if None, the default backend will be opened
+        resolver: if given, wallpaper ids missing from the cache are fetched through it in one batch
         """
 
-        self.cache = Cache()
+        self.cache = cache if cache is not None else open_cache()
+        self.resolver = resolver
+
+        # Built from the whole cache, filters can be answered by its indexes
+        # without materializing every wallpaper first
+        self._from_cache = wallpapers is None
+        # Materialized lazily, but iterators can only be consumed once
+        self._source = wallpapers if wallpapers is None or isinstance(wallpapers, list) else list(wallpapers)
+        self._predicates: tuple[Predicate, ...] = ()
+        # Wallpapers, or only their ids when evaluated over the cache, which
+        # are materialized one at a time through the cache LRU when accessed
+        self._result: Optional[list[Wallpaper | str]] = None
+
+        self._iter: Optional[Iterator[Wallpaper]] = None
+        self._columns: Optional[ColumnSnapshot] = None
+
+    @property
+    def _results(self) -> list[Wallpaper | str]:
+        if self._result is None:
+            self._result = self._run()
+        return self._result
 
-        if wallpapers is None:
-            # Get all cached wallpaper ids
-            wallpapers = list(self.cache)
+    def _wallpaper(self, item: Wallpaper | str) -> Optional[Wallpaper]:
+        return item if isinstance(item, Wallpaper) else self.cache.fetch_wallpaper(item)
 
-        self._wallpapers: list[Wallpaper] = []
+    def _iter_wallpapers(self) -> Iterator[Wallpaper]:
+        for item in self._results:
+            if (wall := self._wallpaper(item)) is not None:
+                yield wall
+
+    def _materialize(self, wallpapers) -> list[Wallpaper]:
+
+        resolved = {}
+        if self.resolver is not None:
+            missing = [wall for wall in wallpapers if isinstance(wall, str) and wall not in self.cache]
+            if missing:
+                resolved = self.resolver.resolve(missing)
+
+        ret = []
         for wall in wallpapers:
             if isinstance(wall, Wallpaper):
-                self._wallpapers.append(wall)
+                ret.append(wall)
             elif isinstance(wall, str):
-                _wall = self.cache.fetch_wallpaper(wall)
+                _wall = resolved.get(wall) or self.cache.fetch_wallpaper(wall)
                 if _wall is None:
                     logger.debug(f'Wallpaper {wall} is not in the cache')
-                    # TODO - add auto fetching through api
                 else:
                     # TODO - wrap with try-except
-                    self._wallpapers.append(_wall)
+                    ret.append(_wall)
             else:
                 logger.debug(f'Wallpaper {wall} is neither a str or Wallpaper instance')
 
-        self._iter = iter(self._wallpapers)
+        # Wallpapers looked up by id are the instances shared through the
+        # cache LRU, and filtering passes the same instances on
+        logger.debug(f'Wallpaper LRU of the cache: {self.cache.lru_stats}')
+        return ret
 
     def __len__(self):
-        return len(self._wallpapers)
+        return len(self._results)
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        if self._iter is None:
+            self._iter = self._iter_wallpapers()
         return next(self._iter)
 
     def __getitem__(self, index):
-        return self._wallpapers[index]
+        if isinstance(index, slice):
+            return [self._wallpaper(item) for item in self._results[index]]
+        return self._wallpaper(self._results[index])
+
+    @property
+    def columns(self) -> ColumnSnapshot:
+        """Columnar snapshot of the resulting wallpapers, built on first use"""
+        if self._columns is None:
+            results = self._results
+            if all(isinstance(item, str) for item in results):
+                # Rows of the columns kept by the cache, so no wallpaper is materialized
+                self._columns = self.cache.columns.snapshot(results)[1]
+            else:
+                self._columns = ColumnSnapshot.from_wallpapers(results)
+        return self._columns
 
-    # TODO - add a caching mechanism for queried results
     def by(self, _by: By, *args, **kwargs) -> Filter:
+        """Filter further, nothing is evaluated until the result is needed
+
+        By.RATIO: ratio_min, ratio_max
+        By.FILE_SIZE: size_min, size_max
+        By.RESOLUTION: min_resolution, max_resolution as (width, height)
+        By.PURITY: purity
+        By.CATEGORY: category
+        By.CREATED: before, after as datetime
+        By.CREATED_DATE: before, after as date or natural language str
+        By.TAG: all_of, any_of, none_of as tag ids or names
+        By.COLOR: colors, as Color or hex str, any of which the wallpaper should have
+        """
+
+        ret = self.__class__(cache=self.cache, resolver=self.resolver)
+        predicate = self._predicate(_by, *args, **kwargs)
+
+        if self._result is not None and not self._from_cache:
+            # Already evaluated, continue from the result instead of redoing it.
+            # Over the cache, planning again on the indexes is as cheap
+            ret._from_cache = False
+            ret._source = self._result
+            ret._predicates = (predicate, )
+        else:
+            ret._from_cache = self._from_cache
+            ret._source = self._source
+            ret._predicates = self._predicates + (predicate, )
+
+        return ret
 
-        method_register = {
-            By.RATIO: self._by_ratio,
-            # By.FILE_SIZE: self._by_filesize,
-            By.PURITY: self._by_purity,
-            By.CATEGORY: self._by_category,
-            # By.CREATED: self._by_created,
-            By.CREATED_DATE: self._by_created_date,
+    @classmethod
+    def _predicate(cls, _by: By, *args, **kwargs) -> Predicate:
+
+        bounds_register = {
+            By.RATIO: cls._ratio_bounds,
+            By.FILE_SIZE: cls._filesize_bounds,
+            By.RESOLUTION: cls._resolution_bounds,
+            By.PURITY: lambda purity: purity.value,
+            By.CATEGORY: lambda category: category.value,
+            By.CREATED: cls._created_bounds,
+            By.CREATED_DATE: cls._created_date_bounds,
+            By.TAG: cls._tag_bounds,
+            By.COLOR: cls._color_bounds,
         }
 
-        return self.__class__(method_register[_by](*args, **kwargs))
+        bounds = bounds_register[_by](*args, **kwargs)
+        # Both are a range of created time once the dates are made inclusive
+        return (By.CREATED if _by == By.CREATED_DATE else _by), bounds
 
-    def _by_ratio(self, ratio_min: Optional[float] = None, ratio_max: Optional[float] = None):
+    @staticmethod
+    def _ratio_bounds(ratio_min: Optional[float] = None,
+                      ratio_max: Optional[float] = None) -> Optional[tuple[float, float]]:
         if ratio_min is None:
             ratio_min = 0.
 
         if ratio_max is None:
             ratio_max = float(1e9)
-        
+
         if not isinstance(ratio_min, float):
             logger.error(f"Given ratio_min value {ratio_min} should be float")
-        elif not isinstance(ratio_min, float):
-            logger.error(f"Given ratio value {ratio_max} should be float")
+        elif not isinstance(ratio_max, float):
+            logger.error(f"Given ratio_max value {ratio_max} should be float")
         else:
-            return filter(lambda x: ((x.ratio or -1) >= ratio_min and (x.ratio or -1) <= ratio_max),
-                          self._wallpapers)
+            return ratio_min, ratio_max
+
+    @staticmethod
+    def _filesize_bounds(size_min: Optional[int] = None,
+                         size_max: Optional[int] = None) -> tuple[int, int]:
+        return (0 if size_min is None else size_min,
+                2 ** 62 if size_max is None else size_max)
 
-    def _by_purity(self, purity: Purity):
-        return filter(lambda x: (x.purity or Purity.NONE) & purity, self._wallpapers)
+    @staticmethod
+    def _resolution_bounds(min_resolution: Optional[tuple[int, int]] = None,
+                           max_resolution: Optional[tuple[int, int]] = None
+                           ) -> tuple[tuple[int, int], tuple[int, int]]:
+        return (tuple(min_resolution or (0, 0)),
+                tuple(max_resolution or (2 ** 31 - 1, 2 ** 31 - 1)))
 
-    def _by_category(self, category: Category):
-        return filter(lambda x: (x.category or Category.NONE) & category, self._wallpapers)
+    @staticmethod
+    def _created_bounds(before: Optional[dt.datetime] = None,
+                        after: Optional[dt.datetime] = None) -> tuple[dt.datetime, dt.datetime]:
+        return (dt.datetime(1900, 1, 1) if after is None else after,
+                dt.datetime(2099, 12, 31, 23, 59, 59) if before is None else before)
 
-    def _by_created_date(self,
-                         before: Optional[dt.date | str] = None,
-                         after: Optional[dt.date | str] = None):
+    @staticmethod
+    def _created_date_bounds(before: Optional[dt.date | str] = None,
+                             after: Optional[dt.date | str] = None) -> tuple[dt.datetime, dt.datetime]:
 
         if before is None:  before = dt.date(2099, 12, 31)
         if after is None:  after = dt.date(1900, 1, 1)
-                
-        before = rectify_date(before)
-        after = rectify_date(after)
-
-        return filter(
-            lambda x:
-            ((x.created_date or dt.date(1899, 12, 31)) >= after)
-            and ((x.created_date or dt.date(1899, 12, 31)) <= before),
-            self._wallpapers)
+
+        # Whole days are included on both ends
+        return (dt.datetime.combine(rectify_date(after), dt.time.min),
+                dt.datetime.combine(rectify_date(before), dt.time(23, 59, 59)))
+
+    @staticmethod
+    def _tag_bounds(all_of: Iterable[str | int] | str | int = (),
+                    any_of: Iterable[str | int] | str | int = (),
+                    none_of: Iterable[str | int] | str | int = ()) -> tuple[frozenset, ...]:
+        """Wallpapers having every tag of all_of, one of any_of and none of none_of
+
+        Tags are given by id as int or by name as str, case-insensitively.
+        Wallpapers without cached details have no known tags and never match.
+        """
+        return tuple(frozenset(Tags.normalize(tag)
+                               for tag in ([tags] if isinstance(tags, (str, int)) else tags))
+                     for tags in (all_of, any_of, none_of))
+
+    @staticmethod
+    def _color_bounds(colors: Iterable[Color | str] | Color | str) -> frozenset[str]:
+        if isinstance(colors, (Color, str)):
+            colors = [colors]
+        return frozenset(Wallpaper.normalize_color(str(color)) for color in colors)
+
+    @property
+    def needs_details(self) -> bool:
+        """Whether some of the recorded filters are on wallpaper details"""
+        return any(p[0] in self.DETAIL_FIELDS for p in self._predicates)
+
+    @property
+    def fingerprint(self) -> str:
+        """Description of the recorded filters that is the same in every process"""
+        def _default(x):
+            # Set order depends on the hash seed of the process
+            if isinstance(x, (set, frozenset)):
+                return sorted(x, key=str)
+            return str(x)
+        return json.dumps(sorted(json.dumps([_by.name, bounds], default=_default)
+                                 for _by, bounds in set(self._predicates)))
+
+    def matches(self, wallpaper: Wallpaper, fields: Optional[Iterable[By]] = None) -> bool:
+        """Whether the wallpaper passes the recorded filters
+
+        The source of the Filter is ignored, so a Filter can be used as a
+        predicate, e.g. Filter([]).by(By.RATIO, 1.7, 1.8).
+
+        fields: only check the filters on these fields, e.g. SEARCH_FIELDS
+        """
+        fields = None if fields is None else set(fields)
+        return all(self._matcher(p)(wallpaper) for p in self._predicates
+                   if fields is None or p[0] in fields)
+
+    @staticmethod
+    def _time_key(x: dt.datetime) -> str:
+        # Same format as the created_at keys of the index
+        return x.strftime('%Y-%m-%d %H:%M:%S')
+
+    def _index_range(self, predicate: Predicate) -> Optional[tuple]:
+        """(index field, lo, hi) answering the predicate, None if not indexed"""
+
+        _by, bounds = predicate
+        if _by == By.RATIO and bounds is not None:
+            return 'ratio', *bounds
+        elif _by == By.FILE_SIZE:
+            return 'file_size', *bounds
+        elif _by == By.RESOLUTION:
+            # Index keys only bound the width, heights are checked on the matches
+            (w_min, _), (w_max, _) = bounds
+            return 'resolution', (w_min, -1), (w_max, 2 ** 31)
+        elif _by == By.CREATED:
+            return 'created', self._time_key(bounds[0]), self._time_key(bounds[1])
+        return None
+
+    def _estimate(self, predicate: Predicate, total: int) -> float:
+        """Estimated number of wallpapers out of total kept by the predicate"""
+
+        _by, bounds = predicate
+        if _by == By.RATIO and bounds is None:
+            return 0
+
+        num_cached = len(self.cache)
+        if num_cached > 0:
+            # Only use indexes already built, it is not worth a scan otherwise
+            secondary, tag_index = self.cache.built_secondary_indexes, self.cache.built_tag_index
+            if (rng := self._index_range(predicate)) is not None and secondary is not None:
+                return total * secondary.count(*rng) / num_cached
+            if _by == By.TAG and tag_index is not None and bounds[0]:
+                return total * min(tag_index.count(tag) for tag in bounds[0]) / num_cached
+
+        return total * self.DEFAULT_SELECTIVITY[_by]
+
+    @classmethod
+    def clear_memo(cls):
+        with cls._memo_lock:
+            cls._memo.clear()
+
+    def _memo_key(self) -> tuple:
+        # Filters are ANDed, so neither their order nor repeats matter
+        return self.cache.identity, frozenset(self._predicates)
+
+    def _run(self) -> list[Wallpaper | str]:
+        """Evaluate the recorded filters, giving ids if run over the cache"""
+
+        if not self._from_cache:
+            source, self._source = self._source, None
+            if self._predicates and all(isinstance(item, str) for item in source):
+                # Only ids, filtered on the columns kept by the cache like a
+                # filter over the whole cache is
+                return self._filter_ids(self._cached_ids(source), list(self._predicates))
+            wallpapers = self._materialize(source)
+            return self._apply(wallpapers, list(self._predicates))
+
+        if not self._predicates:
+            return list(self.cache)
+
+        key = self._memo_key()
+        generation = self.cache.generation
+        with self._memo_lock:
+            memo = self._memo.get(key)
+            if memo is not None and memo[0] == generation:
+                self._memo.move_to_end(key)
+                logger.debug(f'Filter result of {len(memo[1])} wallpapers taken from memo')
+                return memo[1]
+
+        ids = self._run_on_cache()
+
+        with self._memo_lock:
+            self._memo[key] = (generation, ids)
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.MEMO_SIZE:
+                self._memo.popitem(last=False)
+
+        return ids
+
+    def _run_on_cache(self) -> list[str]:
+        """Ids of the cached wallpapers passing the recorded filters"""
+
+        predicates = list(self._predicates)
+
+        ids: Optional[list[str]] = None
+        rest = []
+
+        # The most selective indexed filter gives the candidates
+        indexed = [p for p in predicates if self._index_range(p) is not None]
+        if indexed:
+            indexes = self.cache.secondary_indexes
+            counts = {p: indexes.count(*self._index_range(p)) for p in indexed}
+            driver = min(indexed, key=counts.get)
+            ids = indexes.range(*self._index_range(driver))
+            logger.debug(f'Filter candidates from index: {driver[0]} -> {len(ids)} ids')
+
+            predicates.remove(driver)
+            if driver[0] == By.RESOLUTION:
+                rest.append(driver)
+
+        # Tags are set algebra on the tag index
+        for predicate in [p for p in predicates if p[0] == By.TAG]:
+            all_of, any_of, none_of = predicate[1]
+            tagged = self.cache.tag_index.query(all_of=all_of, any_of=any_of, none_of=none_of)
+            ids = sorted(tagged) if ids is None else [wid for wid in ids if wid in tagged]
+            predicates.remove(predicate)
+
+        return self._filter_ids(ids, rest + predicates)
+
+    def _cached_ids(self, wids: list[str]) -> list[str]:
+        """The given ids that are cached, fetching the missing ones through the resolver"""
+        if self.resolver is not None:
+            missing = [wid for wid in wids if wid not in self.cache]
+            if missing:
+                self.resolver.resolve(missing)
+
+        ret = [wid for wid in wids if wid in self.cache]
+        if len(ret) < len(wids):
+            logger.debug(f'{len(wids) - len(ret)} wallpapers are not in the cache')
+        return ret
+
+    def _filter_ids(self, ids: Optional[list[str]], predicates: list[Predicate]) -> list[str]:
+        """Cached ids passing all the predicates, out of every cached id if ids is None"""
+
+        if not predicates:
+            return list(self.cache) if ids is None else ids
+
+        mask_predicates = [p for p in predicates if p[0] not in self.ROW_ONLY]
+        if mask_predicates and (np := _numpy()) is not None:
+            # Masks over the columns kept by the cache, so only the kept
+            # wallpapers are materialized and nothing is parsed again
+            ids, columns = self.cache.columns.snapshot(ids)
+            mask = self._fused_mask(columns, mask_predicates)
+            ids = [ids[i] for i in np.flatnonzero(mask)]
+            predicates = [p for p in predicates if p[0] in self.ROW_ONLY]
+
+        if ids is None:
+            ids = list(self.cache)
+        if not predicates:
+            return ids
+
+        # One wallpaper at a time, so no more are held than the cache LRU keeps
+        matchers = [self._matcher(p) for p in self._ordered(predicates, len(ids))]
+        return [wid for wid in ids
+                if (wall := self.cache.fetch_wallpaper(wid)) is not None
+                and all(match(wall) for match in matchers)]
+
+    def _ordered(self, predicates: list[Predicate], total: int) -> list[Predicate]:
+        ret = sorted(predicates, key=lambda p: self._estimate(p, total))
+        logger.debug(f'Filter order: {[p[0] for p in ret]}')
+        return ret
+
+    def _apply(self, wallpapers: list[Wallpaper], predicates: list[Predicate]) -> list[Wallpaper]:
+        """Keep the wallpapers passing all the predicates, in one pass"""
+
+        if not predicates:
+            return wallpapers
+
+        predicates = self._ordered(predicates, len(wallpapers))
+        row_predicates = [p for p in predicates if p[0] in self.ROW_ONLY]
+        mask_predicates = [p for p in predicates if p[0] not in self.ROW_ONLY]
+
+        if mask_predicates and (np := _numpy()) is not None:
+            columns = ColumnSnapshot.from_wallpapers(wallpapers)
+            indices = np.flatnonzero(self._fused_mask(columns, mask_predicates))
+            wallpapers = [wallpapers[i] for i in indices]
+        else:
+            row_predicates = predicates
+
+        if row_predicates:
+            matchers = [self._matcher(p) for p in row_predicates]
+            # all() stops at the first failing check, the most selective one
+            wallpapers = [wall for wall in wallpapers if all(match(wall) for match in matchers)]
+
+        return wallpapers
+
+    def _fused_mask(self, columns: ColumnSnapshot, predicates: list[Predicate]):
+
+        predicates = self._ordered(predicates, len(columns))
+
+        mask = _numpy().ones(len(columns), dtype=bool)
+        for predicate in predicates:
+            mask &= self._mask(columns, predicate)
+            if not mask.any():
+                break
+        return mask
+
+    @staticmethod
+    def _mask(columns: ColumnSnapshot, predicate: Predicate):
+        _by, bounds = predicate
+
+        if _by == By.RATIO:
+            if bounds is None:
+                return _numpy().zeros(len(columns), dtype=bool)
+            return columns.mask_ratio(*bounds)
+        elif _by == By.FILE_SIZE:
+            return columns.mask_file_size(*bounds)
+        elif _by == By.RESOLUTION:
+            return columns.mask_resolution(*bounds)
+        elif _by == By.PURITY:
+            return columns.mask_purity(Purity(bounds))
+        elif _by == By.CATEGORY:
+            return columns.mask_category(Category(bounds))
+        elif _by == By.CREATED:
+            return columns.mask_created(*bounds)
+
+        raise ValueError(f'Filter by {_by} has no columnar form')
+
+    @staticmethod
+    def _matcher(predicate: Predicate) -> Callable[[Wallpaper], bool]:
+        _by, bounds = predicate
+
+        if _by == By.RATIO:
+            if bounds is None:
+                return lambda x: False
+            ratio_min, ratio_max = bounds
+            return lambda x: ((x.ratio or -1) >= ratio_min and (x.ratio or -1) <= ratio_max)
+
+        elif _by == By.FILE_SIZE:
+            size_min, size_max = bounds
+            return lambda x: size_min <= (x.file_size or -1) <= size_max
+
+        elif _by == By.RESOLUTION:
+            (w_min, h_min), (w_max, h_max) = bounds
+            return lambda x: (x.resolution is not None
+                              and w_min <= x.resolution[0] <= w_max
+                              and h_min <= x.resolution[1] <= h_max)
+
+        elif _by == By.PURITY:
+            purity = Purity(bounds)
+            return lambda x: bool((x.purity or Purity.NONE) & purity)
+
+        elif _by == By.CATEGORY:
+            category = Category(bounds)
+            return lambda x: bool((x.category or Category.NONE) & category)
+
+        elif _by == By.CREATED:
+            after, before = bounds
+            return lambda x: x.created is not None and after <= x.created <= before
+
+        elif _by == By.COLOR:
+            return lambda x: not bounds.isdisjoint(x.colors)
+
+        elif _by == By.TAG:
+            all_of, any_of, none_of = bounds
+            return lambda x: (x.tags is not None
+                              and all(tag in x.tags for tag in all_of)
+                              and (not any_of or any(tag in x.tags for tag in any_of))
+                              and not any(tag in x.tags for tag in none_of))
+
+        raise ValueError(f'Filter by {_by} is not supported')
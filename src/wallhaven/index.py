@@ -0,0 +1,231 @@
+
+import os
+import json
+import pickle
+import hashlib
+import threading
+from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from .cacher import _cache_dir
+from .filelock import FileLock
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.index')
+
+
+@dataclass
+class IndexEntry:
+
+    path: str
+    size: int
+    mtime: float
+    hash: Optional[str] = None
+
+
+class DownloadIndex:
+    """Persistent index of the wallpaper files downloaded under base_dir
+
+    The index maps wallpaper id to its file, so checking whether a wallpaper
+    is downloaded is an in-memory lookup instead of a stat call. It is built
+    once by scanning the two-character subfolders in parallel, then kept up
+    to date by appending every download to a journal, which is folded into
+    the snapshot on save. Several processes may share the index: appends,
+    loads and saves hold a file lock, and save folds in the records other
+    processes appended before rotating the journal.
+
+    Entries are trusted as they are, so on a network filesystem skipping a
+    downloaded wallpaper costs no metadata round trip. A file deleted or
+    moved behind the back of the index is found out by rebuild, by lookup
+    when verify is set, or by a caller whose read of the file failed and
+    which invalidates the entry.
+    """
+
+    _index_dir = _cache_dir
+
+    def __init__(self, base_dir: str, index_file: Optional[str] = None, scan_workers: int = 8,
+                 rebuild: bool = False, verify: bool = False):
+        """
+        base_dir: base directory wallpapers are saved to
+        index_file: snapshot file, if None, one is derived from base_dir in the cache folder
+        scan_workers: number of threads scanning subfolders when building the index
+        rebuild: scan base_dir even if a snapshot exists
+        verify: stat the file of an entry on lookup, removing the entry if the
+            file is gone or changed size
+        """
+
+        self.base_dir = os.path.abspath(base_dir)
+        self.scan_workers = scan_workers
+        self.verify = verify
+
+        if index_file is None:
+            key = hashlib.md5(self.base_dir.encode()).hexdigest()[:8]
+            index_file = os.path.join(self._index_dir, f'wallhaven_index_{key}.pkl')
+        self.index_file = index_file
+        self.journal_file = index_file + '.journal'
+        self._file_lock = FileLock(index_file + '.lock')
+
+        self._lock = threading.Lock()
+        self._entries: dict[str, IndexEntry] = {}
+
+        if not rebuild and os.path.isfile(self.index_file):
+            self._load()
+        else:
+            self.rebuild()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, wid: str):
+        return wid in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    def get(self, wid: str) -> Optional[IndexEntry]:
+        return self._entries.get(wid)
+
+    def lookup(self, wid: str, verify: Optional[bool] = None) -> Optional[IndexEntry]:
+        """Entry of the wallpaper, checked against the disk if verify
+
+        verify: if None, as given to the index. Checking costs a stat, and
+            an entry whose file is gone or changed size is removed, so the
+            wallpaper is downloaded again.
+        """
+        entry = self._entries.get(wid)
+        if entry is None or not (self.verify if verify is None else verify):
+            return entry
+
+        try:
+            size = os.stat(entry.path).st_size
+        except FileNotFoundError:
+            size = None
+        if size == entry.size:
+            return entry
+
+        logger.info(f'Indexed file {entry.path} of wallpaper {wid} is '
+                    + ('gone' if size is None else f'{size} bytes instead of {entry.size}')
+                    + ', removed from the index')
+        self.remove(wid)
+        return None
+
+    def invalidate(self, wid: str, reason: str = 'cannot be read'):
+        """Remove the entry of a wallpaper whose indexed file turned out unusable"""
+        entry = self._entries.get(wid)
+        if entry is not None:
+            logger.info(f'Indexed file {entry.path} of wallpaper {wid} {reason}, removed from the index')
+            self.remove(wid)
+
+    def items(self):
+        return list(self._entries.items())
+
+    @staticmethod
+    def wallpaper_id(filename: str) -> str:
+        """Wallpaper id of a saved file, e.g. abc123 for abc123.jpg"""
+        return filename.split('.', 1)[0]
+
+    def _replay(self, entries: dict[str, IndexEntry]) -> int:
+        """Apply the journal records to entries, return the number of records"""
+        num_replayed = 0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be truncated by a crash
+                        continue
+                    wid = record.pop('id')
+                    if record.get('removed'):
+                        entries.pop(wid, None)
+                    else:
+                        entries[wid] = IndexEntry(**record)
+                    num_replayed += 1
+        return num_replayed
+
+    def _load(self):
+        # Locked so that no save rotates the journal between the two reads
+        with self._file_lock:
+            with open(self.index_file, 'rb') as f:
+                self._entries = pickle.load(f)
+            num_replayed = self._replay(self._entries)
+
+        logger.debug(f'Loaded {len(self._entries)} entries from download index {self.index_file}'
+                     f' ({num_replayed} replayed from journal)')
+
+    def _scan_subfolder(self, path: str) -> dict[str, IndexEntry]:
+        ret = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith('.part'):
+                    continue
+                stat = entry.stat()
+                ret[self.wallpaper_id(entry.name)] = IndexEntry(
+                    path=entry.path, size=stat.st_size, mtime=stat.st_mtime)
+        return ret
+
+    def rebuild(self):
+        """Scan base_dir and replace the index with what is found on disk"""
+
+        logger.info(f'Building download index for {self.base_dir}')
+
+        subfolders = []
+        if os.path.isdir(self.base_dir):
+            with os.scandir(self.base_dir) as it:
+                # Hidden folders, e.g. a content store, are not wallpaper subfolders
+                subfolders = [entry.path for entry in it
+                              if entry.is_dir() and not entry.name.startswith('.')]
+
+        entries = {}
+        with ThreadPoolExecutor(max_workers=self.scan_workers) as executor:
+            for ret in executor.map(self._scan_subfolder, subfolders):
+                entries.update(ret)
+
+        with self._lock:
+            self._entries = entries
+
+        logger.info(f'Found {len(entries)} files in {len(subfolders)} subfolders of {self.base_dir}')
+        self.save()
+
+    def _append_journal(self, record: dict):
+        with self._file_lock, open(self.journal_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def add(self, wid: str, path: str, hash: Optional[str] = None):
+        """Record a file just written to path"""
+        stat = os.stat(path)
+        entry = IndexEntry(path=path, size=stat.st_size, mtime=stat.st_mtime, hash=hash)
+
+        with self._lock:
+            self._entries[wid] = entry
+            self._append_journal({'id': wid, **asdict(entry)})
+
+    def remove(self, wid: str):
+        with self._lock:
+            if self._entries.pop(wid, None) is not None:
+                self._append_journal({'id': wid, 'removed': True})
+
+    def save(self):
+        dirname = os.path.dirname(self.index_file)
+        if not os.path.isdir(dirname):
+            logger.debug(f'Index folder {dirname} does not exist, create one')
+            os.makedirs(dirname, exist_ok=True)
+
+        with self._lock, self._file_lock:
+            # Pick up what other processes appended, ours is already in
+            # memory and replaying it again changes nothing
+            num_replayed = self._replay(self._entries)
+
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self._entries, f)
+            os.replace(tmp_file, self.index_file)
+
+            # Everything in the journal is now part of the snapshot, and no
+            # one can append to it until the lock is released
+            if os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+
+            logger.debug(f'Saved {len(self._entries)} index entries to {self.index_file}'
+                         f' ({num_replayed} journal records folded in)')
@@ -0,0 +1,163 @@
+
+import os
+import json
+import hashlib
+import threading
+from typing import Iterator, Optional
+
+from .cacher import _cache_dir
+from .filelock import fcntl
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.journal')
+
+
+class RunJournal:
+    """Append-only record of the progress of a fetcher run
+
+    Each line records a wallpaper id reaching a stage, along with the json
+    known at that stage, so an interrupted run can be resumed: listed
+    wallpapers are not searched for again once the listing is done, fetched
+    details are put back into the cache even if it was not saved, and
+    verified downloads are skipped.
+
+    The journal file is named after a hash of the run parameters, so only
+    a run asking for the same work resumes from it, and is locked while in
+    use, so two such runs at once do not overwrite each other's records.
+    """
+
+    STAGES = ('listed', 'detailed', 'downloaded', 'verified')
+
+    # Record telling the listing went through to the end
+    LISTING_DONE = 'listing_done'
+    # First record, parameters of the run
+    PARAMS = 'params'
+
+    _journal_dir = _cache_dir
+
+    def __init__(self, name: str, resume: bool = False, journal_file: Optional[str] = None,
+                 params: Optional[dict] = None):
+        """
+        name: name of the kind of run, e.g. daily, the journal file is derived from it
+        resume: load the journal left by an earlier run, otherwise start a new one
+        journal_file: journal file, if None, one is derived from name and params in the cache folder
+        params: parameters of the run, a journal left with other ones is not resumed
+        """
+
+        self.params = json.loads(self._dumps(params or {}))
+        digest = hashlib.sha1(self._dumps(self.params).encode()).hexdigest()[:12]
+        self.journal_file = (journal_file if journal_file is not None
+                             else os.path.join(self._journal_dir, f'wallhaven_run_{name}_{digest}.jsonl'))
+
+        self._lock = threading.Lock()
+        self._stages: dict[str, int] = {}
+        self._listed: dict[str, dict] = {}
+        self._details: dict[str, dict] = {}
+        self.listing_done = False
+
+        dirname = os.path.dirname(self.journal_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # Line buffered, so every record is written out as soon as it is made.
+        # Opened for append, the file is only truncated once locked
+        self._file = open(self.journal_file, 'a', buffering=1)
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._file.close()
+                raise RuntimeError(f'Journal {self.journal_file} is in use by another run'
+                                   ' with the same parameters')
+
+        if resume and os.path.getsize(self.journal_file) > 0 and self._load():
+            return
+        if resume:
+            logger.info(f'No journal of this run found at {self.journal_file}, starting a new run')
+
+        self._file.truncate(0)
+        self._file.write(self._dumps({'stage': self.PARAMS, 'params': self.params}) + '\n')
+
+    @staticmethod
+    def _dumps(record: dict) -> str:
+        return json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+
+    def _load(self) -> bool:
+        """Load the records, return False if the journal is of another run"""
+        with open(self.journal_file, 'r') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated by a crash
+                    continue
+                if i == 0:
+                    if record.get('stage') != self.PARAMS or record.get('params') != self.params:
+                        logger.warning(f'Journal {self.journal_file} was left by a run with other'
+                                       ' parameters, ignored')
+                        return False
+                    continue
+                self._apply(record)
+
+        logger.info(f'Resuming from journal {self.journal_file}: {len(self._listed)} listed'
+                    f' (listing done: {self.listing_done}), {len(self._details)} detailed,'
+                    f' {self.count("verified")} verified')
+        return True
+
+    def _apply(self, record: dict):
+        stage = record['stage']
+        if stage == self.LISTING_DONE:
+            self.listing_done = True
+            return
+
+        wid = record['id']
+        self._stages[wid] = max(self._stages.get(wid, -1), self.STAGES.index(stage))
+        if stage == 'listed':
+            # Listed without data when the id is all there is to know
+            self._listed[wid] = record.get('data') or {'id': wid}
+        elif stage == 'detailed' and 'data' in record:
+            self._details[wid] = record['data']
+
+    def record(self, wid: str, stage: str, data: Optional[dict] = None):
+        """Record wallpaper wid reaching stage, data being its json at that stage"""
+        record = {'id': wid, 'stage': stage}
+        if data is not None:
+            record['data'] = data
+
+        with self._lock:
+            self._apply(record)
+            self._file.write(self._dumps(record) + '\n')
+
+    def mark_listing_done(self):
+        with self._lock:
+            self.listing_done = True
+            self._file.write(self._dumps({'stage': self.LISTING_DONE}) + '\n')
+
+    def done(self, wid: str, stage: str) -> bool:
+        """Whether wallpaper wid reached stage or a later one"""
+        return self._stages.get(wid, -1) >= self.STAGES.index(stage)
+
+    def is_listed(self, wid: str) -> bool:
+        """Whether wallpaper wid has a listing record, which done cannot tell once it went further"""
+        return wid in self._listed
+
+    def count(self, stage: str) -> int:
+        return sum(1 for wid in self._stages if self.done(wid, stage))
+
+    def listed(self) -> Iterator[dict]:
+        """Json of the listed wallpapers, in the order they were listed"""
+        yield from list(self._listed.values())
+
+    def details(self) -> Iterator[dict]:
+        """Json of the wallpapers whose details were fetched"""
+        yield from list(self._details.values())
+
+    def close(self, remove: bool = False):
+        """Close the journal, remove it if the run is complete"""
+        with self._lock:
+            if self._file.closed:
+                return
+            # Removed while still locked, so no other run opens it in between
+            if remove and os.path.isfile(self.journal_file):
+                os.remove(self.journal_file)
+                logger.debug(f'Run complete, removed journal {self.journal_file}')
+            self._file.close()
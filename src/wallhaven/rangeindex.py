@@ -0,0 +1,154 @@
+
+import bisect
+import threading
+from typing import Callable, Iterable, Optional
+
+from .columns import _parse_resolution
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.rangeindex')
+
+
+class SortedIndex:
+    """Wallpaper ids sorted by one field, for range queries with bisect
+
+    Keys and ids are kept in two parallel lists sorted by (key, id), so a
+    range query costs O(log N + k) and an entry is found with a bisect even
+    among many equal keys. Wallpapers missing the field are not indexed.
+    """
+
+    def __init__(self, key_func: Callable[[dict], Optional[object]]):
+        """
+        key_func: gets the sort key from the json of a wallpaper, None if missing
+        """
+        self.key_func = key_func
+        self._keys: list = []
+        self._ids: list[str] = []
+        self._key_of: dict[str, object] = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        """Replace the index with the given (wallpaper id, json) pairs"""
+        pairs = []
+        for wid, json in items:
+            if (key := self.key_func(json)) is not None:
+                pairs.append((key, wid))
+        pairs.sort()
+
+        self._keys = [key for key, _ in pairs]
+        self._ids = [wid for _, wid in pairs]
+        self._key_of = {wid: key for key, wid in pairs}
+
+    def _position(self, key, wid: str) -> int:
+        # Ids are sorted among equal keys, so the ties are bisected too
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key, lo)
+        return bisect.bisect_left(self._ids, wid, lo, hi)
+
+    def _remove(self, wid: str):
+        key = self._key_of.pop(wid, None)
+        if key is None:
+            return
+        pos = self._position(key, wid)
+        del self._keys[pos]
+        del self._ids[pos]
+
+    def add(self, wid: str, json: dict):
+        """Insert or move the entry of the wallpaper"""
+        key = self.key_func(json)
+        if key is not None and self._key_of.get(wid) == key:
+            return
+        self._remove(wid)
+        if key is None:
+            return
+        pos = self._position(key, wid)
+        self._keys.insert(pos, key)
+        self._ids.insert(pos, wid)
+        self._key_of[wid] = key
+
+    def _bounds(self, lo, hi) -> tuple[int, int]:
+        start = 0 if lo is None else bisect.bisect_left(self._keys, lo)
+        end = len(self._keys) if hi is None else bisect.bisect_right(self._keys, hi)
+        return start, max(start, end)
+
+    def range(self, lo=None, hi=None) -> list[str]:
+        """Ids with lo <= key <= hi in key order, open ended if a bound is None"""
+        start, end = self._bounds(lo, hi)
+        return self._ids[start:end]
+
+    def count(self, lo=None, hi=None) -> int:
+        start, end = self._bounds(lo, hi)
+        return end - start
+
+
+def _float_key(field):
+    def _key(json):
+        try:
+            return float(json[field])
+        except (KeyError, TypeError, ValueError):
+            return None
+    return _key
+
+
+def _int_key(field):
+    def _key(json):
+        try:
+            return int(json[field])
+        except (KeyError, TypeError, ValueError):
+            return None
+    return _key
+
+
+def _created_key(json):
+    # '%Y-%m-%d %H:%M:%S' sorts the same as the time it stands for, so the
+    # string is used as is and no parsing is needed
+    return json.get('created_at') or None
+
+
+def _resolution_key(json):
+    width, height = _parse_resolution(json.get('resolution'))
+    return None if width < 0 else (width, height)
+
+
+class SecondaryIndexes:
+    """Sorted indexes over the range-queried fields of a cache
+
+    created keys are the raw created_at strings and resolution keys are
+    (width, height) tuples, so a resolution range only bounds the width.
+    """
+
+    FIELDS = {
+        'created': _created_key,
+        'ratio': _float_key('ratio'),
+        'file_size': _int_key('file_size'),
+        'resolution': _resolution_key,
+    }
+
+    def __init__(self):
+        self.indexes = {field: SortedIndex(key_func) for field, key_func in self.FIELDS.items()}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, field: str) -> SortedIndex:
+        return self.indexes[field]
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        items = list(items)
+        with self._lock:
+            for index in self.indexes.values():
+                index.build(items)
+        logger.debug(f'Built secondary indexes over {len(items)} cached wallpapers')
+
+    def add(self, wid: str, json: dict):
+        with self._lock:
+            for index in self.indexes.values():
+                index.add(wid, json)
+
+    def range(self, field: str, lo=None, hi=None) -> list[str]:
+        with self._lock:
+            return self.indexes[field].range(lo, hi)
+
+    def count(self, field: str, lo=None, hi=None) -> int:
+        with self._lock:
+            return self.indexes[field].count(lo, hi)
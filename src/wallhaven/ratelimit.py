@@ -0,0 +1,397 @@
+
+import os
+import json
+import time
+import random
+import threading
+import contextlib
+import email.utils
+from typing import Optional
+
+from .cacher import _cache_dir
+from .filelock import fcntl
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.ratelimit')
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date"""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+    except (TypeError, ValueError):
+        logger.debug(f'Failed to parse Retry-After header {value}')
+        return None
+
+
+def backoff_wait(attempt: int, retry_after: Optional[float] = None,
+                 base: float = 5., cap: float = 120.) -> float:
+    """Seconds to wait before retry number attempt (from 1) of a throttled request
+
+    Retry-After is honored when given, otherwise the wait grows
+    exponentially from base. Jitter is added in both cases so that
+    throttled workers do not all come back at the same moment.
+    """
+    if retry_after is not None:
+        return min(retry_after, cap) + random.uniform(0, base / 2)
+    return random.uniform(base / 2, min(base * 2 ** (attempt - 1), cap))
+
+
+class TokenBucket:
+    """Token bucket rate limiter shared by all threads of the process
+
+    Tokens refill continuously at `rate` per second up to `capacity`, which
+    is the allowed burst. Callers reserve tokens up front, so concurrent
+    callers are queued in order and each one sleeps exactly as long as
+    needed instead of polling.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.):
+        """
+        rate: number of tokens refilled per second, must be positive
+        capacity: max number of tokens that can be accumulated, i.e. burst size
+        """
+        if rate <= 0:
+            raise ValueError(f'Given rate {rate} should be positive')
+        if capacity < 1:
+            raise ValueError(f'Given capacity {capacity} should be at least 1')
+
+        self.rate = rate
+        self.capacity = capacity
+
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._last = time.time()
+
+    def _load(self) -> tuple[float, float]:
+        return self._tokens, self._last
+
+    def _store(self, tokens: float, last: float):
+        self._tokens, self._last = tokens, last
+
+    def _take(self, tokens: float) -> float:
+        now = time.time()
+        avail, last = self._load()
+        avail = min(self.capacity, avail + max(now - last, 0.) * self.rate)
+
+        # Tokens may go negative: the deficit is the queue of callers that
+        # already reserved a slot in the future
+        avail -= tokens
+        self._store(avail, now)
+
+        return max(-avail / self.rate, 0.)
+
+    def reserve(self, tokens: float = 1.) -> float:
+        """Take tokens and return the seconds to wait before using them"""
+        with self._lock:
+            return self._take(tokens)
+
+    def acquire(self, tokens: float = 1.) -> float:
+        """Block until the tokens are available, return the time waited"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.debug(f'Rate limited, waiting for {wait:.3f} seconds')
+            time.sleep(wait)
+        return wait
+
+    # Feedback hooks, a fixed rate limiter ignores them, see AdaptiveLimiter
+
+    def on_success(self):
+        """Report a request that went through"""
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        """Report a request answered with 429"""
+
+    def slot(self):
+        """Context held while a request is in flight"""
+        return contextlib.nullcontext()
+
+    def save(self):
+        """Persist what was learned about the sustainable rate"""
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket whose state is kept in a file guarded by flock
+
+    All processes on the host using the same file share one budget, e.g. the
+    daily cron fetcher and a manual IDFetcher run.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1., path: Optional[str] = None, name: str = 'api'):
+        if fcntl is None:
+            raise RuntimeError('File based rate limiter requires fcntl, which is not available on this platform')
+
+        super().__init__(rate, capacity)
+
+        self.path = path if path is not None else os.path.join(_cache_dir, f'wallhaven_ratelimit_{name}.json')
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            logger.debug(f'Rate limiter folder {dirname} does not exist, create one')
+            os.makedirs(dirname, exist_ok=True)
+
+        self._file = None
+
+    def _load(self) -> tuple[float, float]:
+        self._file.seek(0)
+        try:
+            state = json.loads(self._file.read())
+            return float(state['tokens']), float(state['last'])
+        except (ValueError, KeyError, TypeError):
+            # Empty or garbled state file, start with a full bucket
+            return self.capacity, time.time()
+
+    def _store(self, tokens: float, last: float):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(json.dumps({'tokens': tokens, 'last': last}))
+        self._file.flush()
+
+    def reserve(self, tokens: float = 1.) -> float:
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+') as self._file:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+                try:
+                    return self._take(tokens)
+                finally:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+                    self._file = None
+
+
+class AdaptiveLimiter:
+    """Rate and concurrency limiter adjusted by how the server responds
+
+    Additive increase, multiplicative decrease: every INCREASE_EVERY clean
+    responses the rate of the underlying bucket goes up by RATE_STEP of
+    max_rate and one more request may be in flight, while a 429 halves both
+    and holds every caller back for as long as Retry-After asks. The rate
+    and concurrency reached are saved, so the next run starts from the last
+    sustainable throughput instead of from scratch.
+    """
+
+    INCREASE_EVERY = 10
+    RATE_STEP = 0.05
+    DECREASE_FACTOR = 0.5
+
+    # Seconds between two saves of the learned state while running
+    SAVE_INTERVAL = 30
+
+    def __init__(self,
+                 bucket: TokenBucket,
+                 name: str,
+                 max_rate: float,
+                 min_rate: Optional[float] = None,
+                 max_concurrency: int = 1,
+                 state_file: Optional[str] = None):
+        """
+        bucket: token bucket whose rate is adjusted
+        name: name of the limiter, the state file is derived from it
+        max_rate: rate never to go above, e.g. the documented API limit
+        min_rate: rate never to go below, if None, an eighth of the initial rate
+        max_concurrency: max number of requests in flight
+        """
+        self.bucket = bucket
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else bucket.rate / 8
+        self.max_concurrency = max_concurrency
+        self.state_file = (state_file if state_file is not None
+                           else os.path.join(_cache_dir, f'wallhaven_adaptive_{name}.json'))
+
+        self.concurrency = 1
+        self._load()
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._num_clean = 0
+        self._hold_until = 0.
+        self._recover_after = 0.
+        self._last_save = time.time()
+
+        self.num_throttled = 0
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.bucket.rate = min(max(float(state['rate']), self.min_rate), self.max_rate)
+            self.concurrency = min(max(int(state['concurrency']), 1), self.max_concurrency)
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError):
+            logger.debug(f'Garbled adaptive limiter state {self.state_file}, ignored')
+            return
+        logger.debug(f'Limiter {self.name} starts from saved rate {self.rate:.3f}/s'
+                     f' and concurrency {self.concurrency}')
+
+    def save(self):
+        dirname = os.path.dirname(self.state_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'rate': self.rate, 'concurrency': self.concurrency}, f)
+        os.replace(tmp_file, self.state_file)
+        self._last_save = time.time()
+
+    def reserve(self, tokens: float = 1.) -> float:
+        hold = max(self._hold_until - time.time(), 0.)
+        return hold + self.bucket.reserve(tokens)
+
+    def acquire(self, tokens: float = 1.) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logger.debug(f'Rate limited, waiting for {wait:.3f} seconds')
+            time.sleep(wait)
+        return wait
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            self._num_clean += 1
+            if self._num_clean < self.INCREASE_EVERY:
+                return
+            self._num_clean = 0
+
+            self.bucket.rate = min(self.rate + self.RATE_STEP * self.max_rate, self.max_rate)
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._cond.notify()
+            logger.debug(f'Limiter {self.name} increased to {self.rate:.3f}/s, concurrency {self.concurrency}')
+
+        if time.time() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        now = time.time()
+        with self._cond:
+            self.num_throttled += 1
+            self._num_clean = 0
+            if retry_after is not None:
+                self._hold_until = max(self._hold_until, now + retry_after)
+
+            # Requests in flight when the limit was hit get 429 as well, only
+            # back off once for all of them
+            if now < self._recover_after:
+                return
+            self._recover_after = now + max(retry_after or 0., 1 / self.rate)
+
+            self.bucket.rate = max(self.rate * self.DECREASE_FACTOR, self.min_rate)
+            self.concurrency = max(int(self.concurrency * self.DECREASE_FACTOR), 1)
+
+        logger.info(f'Limiter {self.name} throttled, backing off to {self.rate:.3f}/s,'
+                    f' concurrency {self.concurrency}'
+                    + (f', holding for {retry_after:.1f}s' if retry_after is not None else ''))
+        self.save()
+
+
+_limiters: dict[str, TokenBucket | AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _reconcile(name: str, limiter: TokenBucket | AdaptiveLimiter, rate: float, capacity: float,
+               shared: bool, adaptive: bool, max_rate: Optional[float],
+               max_concurrency: int) -> TokenBucket | AdaptiveLimiter:
+    """Bring a registered limiter in line with another request for it
+
+    Requests under one name share one budget, so the most conservative
+    setting wins: the lowest capacity and the lowest rate asked for, which
+    is a cap for a fixed rate and max_rate for an adaptive one. A fixed
+    limiter asked to adapt is wrapped, earlier holders keep using the bucket
+    underneath so they follow its rate, but only new holders report back.
+    """
+    bucket = limiter.bucket if isinstance(limiter, AdaptiveLimiter) else limiter
+    if shared and not isinstance(bucket, FileTokenBucket):
+        raise ValueError(f'Rate limiter {name} is already in use within this process only, the shared'
+                         ' one must be requested before any other limiter of that name')
+
+    changes = []
+    if capacity < bucket.capacity:
+        bucket.capacity = capacity
+        changes.append(f'capacity {capacity}')
+
+    cap = (max_rate if max_rate is not None else rate) if adaptive else rate
+    if isinstance(limiter, AdaptiveLimiter):
+        if cap < limiter.max_rate:
+            limiter.max_rate = cap
+            limiter.min_rate = min(limiter.min_rate, cap)
+            bucket.rate = min(bucket.rate, cap)
+            changes.append(f'max rate {cap:.3f}/s')
+        if adaptive and max_concurrency < limiter.max_concurrency:
+            limiter.max_concurrency = max_concurrency
+            limiter.concurrency = min(limiter.concurrency, max_concurrency)
+            changes.append(f'max concurrency {max_concurrency}')
+    elif adaptive:
+        limiter = AdaptiveLimiter(bucket, name, max_rate=min(cap, bucket.rate),
+                                  max_concurrency=max_concurrency)
+        changes.append(f'adaptive up to {limiter.max_rate:.3f}/s')
+    elif rate < bucket.rate:
+        bucket.rate = rate
+        changes.append(f'rate {rate:.3f}/s')
+
+    if changes:
+        logger.info(f'Rate limiter {name} already in use, changed to ' + ', '.join(changes))
+    return limiter
+
+
+def get_rate_limiter(name: str, rate: float, capacity: float = 1., shared: bool = False,
+                     adaptive: bool = False, max_rate: Optional[float] = None,
+                     max_concurrency: int = 1) -> TokenBucket | AdaptiveLimiter:
+    """Return the limiter registered under name, creating it if needed
+
+    Limiters are shared by name within the process, and with shared=True also
+    across processes on the host through a lock file. If the name is already
+    registered, the limiter is adjusted to satisfy both requests, see
+    _reconcile, and ValueError is raised when that is not possible.
+
+    adaptive: adjust the rate and concurrency to the responses, see AdaptiveLimiter
+    max_rate: upper bound of an adaptive rate, if None, the given rate
+    max_concurrency: upper bound of the adaptive number of requests in flight
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is not None:
+            limiter = _limiters[name] = _reconcile(name, limiter, rate, capacity, shared, adaptive,
+                                                   max_rate, max_concurrency)
+            return limiter
+
+        if shared:
+            limiter = FileTokenBucket(rate, capacity, name=name)
+        else:
+            limiter = TokenBucket(rate, capacity)
+        logger.debug(f'Created {limiter.__class__.__name__} {name} with rate {rate:.3f}/s'
+                     f' and capacity {capacity}')
+
+        if adaptive:
+            limiter = AdaptiveLimiter(limiter, name,
+                                      max_rate=max_rate if max_rate is not None else rate,
+                                      max_concurrency=max_concurrency)
+        _limiters[name] = limiter
+        return limiter
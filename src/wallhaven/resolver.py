@@ -0,0 +1,136 @@
+
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Optional
+
+from .defs import Wallpaper
+from .api import API
+from .cacher import BaseCache, open_cache
+from ..exceptions import UnknownResponseError, MaxRetryReachedError, UnauthorizedError
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.resolver')
+
+
+class DetailResolver:
+    """Look up the details of many wallpaper ids at once
+
+    Ids are normalized and deduplicated, the ones already cached are taken
+    from the cache, and the rest are requested by a pool of workers. All
+    requests go through the rate limiter of the API, which is shared by name
+    with the fetchers, so the workers only overlap the waiting on responses
+    and never exceed the allowed rate.
+
+    Failed lookups are counted in the cached json of the wallpaper, and ids
+    that failed MAX_FAILURES times are not requested again.
+    """
+
+    # Number of newly fetched details between two cache saves
+    CACHE_SAVE_EVERY = 200
+
+    # Key of the number of failed lookups in the cached json
+    FAILURES_KEY = 'detail_failures'
+    MAX_FAILURES = 3
+
+    def __init__(self,
+                 api: Optional[API] = None,
+                 cache: Optional[BaseCache] = None,
+                 workers: int = 4,
+                 cache_lock: Optional[threading.Lock] = None):
+        """
+        api: API to request details with, if None, one with the default settings is created
+        cache: cache to look up and add details to, if None, the default backend will be opened
+        workers: number of threads requesting details
+        cache_lock: lock held while writing to the cache, to share with other writers
+        """
+        self.api = api if api is not None else API()
+        self.cache = cache if cache is not None else open_cache()
+        self.workers = workers
+        self._lock = cache_lock if cache_lock is not None else threading.Lock()
+
+    @staticmethod
+    def normalize_ids(wids: Iterable[str]) -> list[str]:
+        """Strip ids, e.g. of the newline left by readlines, drop blank and repeated ones"""
+        ret = {}
+        for wid in wids:
+            wid = str(wid).strip()
+            if wid:
+                ret[wid] = None
+        return list(ret)
+
+    def _fetch(self, wid: str) -> Optional[dict]:
+        # Any failure only loses this id, never the rest of the batch
+        try:
+            json = self.api.get_wallpaper_info(wid).json()
+            if "error" in json:
+                logger.warning(f"Encountered error when fetching details for wallpaper {wid}: {json['error']}")
+                return None
+            return json['data']
+        except (UnknownResponseError, MaxRetryReachedError, UnauthorizedError,
+                requests.RequestException, ValueError, KeyError) as e:
+            # ValueError covers a body that is not valid json
+            logger.warning(f"Encountered error when fetching details for wallpaper {wid}", exc_info=e)
+            return None
+
+    def _mark_failed(self, wid: str):
+        json = dict(self.cache.get(wid) or {'id': wid})
+        json[self.FAILURES_KEY] = json.get(self.FAILURES_KEY, 0) + 1
+        self.cache.add(Wallpaper(json))
+
+    def _given_up(self, wall: Wallpaper) -> bool:
+        return wall.get(self.FAILURES_KEY, 0) >= self.MAX_FAILURES
+
+    def resolve(self, wids: Iterable[str], save: bool = True) -> dict[str, Wallpaper]:
+        """Wallpapers of the given ids with their details, failed lookups are left out
+
+        save: save the cache once done, a caller resolving many small batches
+            may rather save it itself
+        """
+
+        wids = self.normalize_ids(wids)
+
+        ret = {}
+        missing = []
+        num_given_up = 0
+        for wid in wids:
+            if (wall := self.cache.fetch_wallpaper(wid)) is not None and wall.tags is not None:
+                ret[wid] = wall
+            elif wall is not None and self._given_up(wall):
+                num_given_up += 1
+            else:
+                missing.append(wid)
+
+        logger.info(f'Resolving {len(wids)} wallpapers: {len(ret)} cached, {len(missing)} to fetch,'
+                    f' {num_given_up} failed too many times before')
+        if not missing:
+            return {wid: ret[wid] for wid in wids if wid in ret}
+
+        num_unsaved = 0
+        num_fetched = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='wallhaven-resolver') as executor:
+                futures = {executor.submit(self._fetch, wid): wid for wid in missing}
+                # Cache is only written from the calling thread
+                for future in as_completed(futures):
+                    json = future.result()
+                    with self._lock:
+                        if json is None:
+                            self._mark_failed(futures[future])
+                        else:
+                            wall = Wallpaper(json)
+                            self.cache.add(wall)
+                            ret[wall.id] = wall
+                            num_fetched += 1
+                        num_unsaved += 1
+                        if num_unsaved >= self.CACHE_SAVE_EVERY:
+                            self.cache.save()
+                            num_unsaved = 0
+        finally:
+            # Keep what was fetched even if the batch is interrupted
+            if save and num_unsaved > 0:
+                with self._lock:
+                    self.cache.save()
+
+        logger.info(f'Fetched details for {num_fetched} of {len(missing)} wallpapers')
+        return {wid: ret[wid] for wid in wids if wid in ret}
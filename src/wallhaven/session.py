@@ -0,0 +1,140 @@
+
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.session')
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter remembering the counters of connection pools it disposed"""
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._disposed_requests = 0
+        self._disposed_connections = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        # Pools evicted from the PoolManager are closed and dropped, keep
+        # their counters so that the stats survive host churn
+        pools = self.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def _dispose(pool):
+            with self._lock:
+                self._disposed_requests += pool.num_requests
+                self._disposed_connections += pool.num_connections
+            if dispose is not None:
+                dispose(pool)
+
+        pools.dispose_func = _dispose
+
+    def counters(self) -> tuple[int, int]:
+        """Return (requests, new connections) made through this adapter"""
+        with self._lock:
+            num_requests = self._disposed_requests
+            num_connections = self._disposed_connections
+
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+        return num_requests, num_connections
+
+
+class SessionPool:
+    """Keep-alive HTTP session shared by the API and the fetchers
+
+    Connections to wallhaven.cc (API) and w.wallhaven.cc (images) are pooled
+    and reused across calls, so only the first request to each host pays for
+    the TCP+TLS handshake. Connection errors and 5xx responses are retried by
+    urllib3, while 429 is left to the caller as it needs to be throttled.
+    """
+
+    RETRY_STATUS = (500, 502, 503, 504)
+
+    def __init__(self,
+                 pool_connections: int = 4,
+                 pool_maxsize: int = 8,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 timeout: Optional[float | tuple[float, float]] = (10, 60)):
+        """
+        pool_connections: number of hosts to keep connection pools for
+        pool_maxsize: max number of kept-alive connections per host
+        max_retries: retries on connection errors and 5xx responses
+        backoff_factor: exponential backoff factor between retries
+        timeout: default (connect, read) timeout for each request
+        """
+
+        self.timeout = timeout
+
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=self.RETRY_STATUS,
+                      allowed_methods=frozenset(['GET', 'HEAD']),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+
+        self._adapter = _CountingAdapter(pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize,
+                                         max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('get', url, **kwargs)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        num_requests, num_connections = self._adapter.counters()
+        return {
+            'requests': num_requests,
+            'connections': num_connections,
+            'reused': max(num_requests - num_connections, 0),
+        }
+
+    def log_stats(self):
+        stats = self.stats
+        logger.info(f"HTTP connection stats: {stats['requests']} requests over"
+                    f" {stats['connections']} connections ({stats['reused']} reused)")
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_session: Optional[SessionPool] = None
+_default_session_lock = threading.Lock()
+
+
+def get_default_session() -> SessionPool:
+    """Return the process-wide session shared when none is given explicitly"""
+    global _default_session
+
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = SessionPool()
+        return _default_session
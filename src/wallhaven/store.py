@@ -0,0 +1,173 @@
+
+import os
+import errno
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from .verify import StreamVerifier
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.store')
+
+
+class ContentStore:
+    """Content-addressed store of wallpaper files
+
+    Each distinct content is kept once as <root>/<xx>/<digest><ext>, keyed by
+    the same hash computed while downloading. Files in the usual
+    <base_dir>/<xx>/<name> layout are links into the store, so the same image
+    saved under several wallpaper ids only takes its space once.
+    """
+
+    LINK_TYPES = ('hard', 'symlink')
+
+    def __init__(self, root: str, link: str = 'hard'):
+        """
+        root: folder to keep the stored contents in
+        link: hard for hardlinks, falling back to symlinks when root is on
+            another filesystem, or symlink
+        """
+        if link not in self.LINK_TYPES:
+            raise ValueError(f'Given link type {link} should be one of {self.LINK_TYPES}')
+
+        self.root = os.path.abspath(root)
+        self.link = link
+
+        # Serialize puts so that two copies of one content do not race
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest: str, ext: str = '') -> str:
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    @staticmethod
+    def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+        h = hashlib.new(StreamVerifier.HASH_ALGORITHM)
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _link(self, blob: str, path: str) -> bool:
+        """Replace path with a link to blob
+
+        A hardlink across filesystems falls back to a symlink. Return False if
+        no link could be made and path is kept as a plain copy.
+        """
+        # Link under a temporary name first so that path is replaced atomically
+        tmp_path = path + '.link'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+        link = self.link
+        if link == 'hard':
+            try:
+                os.link(blob, tmp_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                logger.debug(f'{path} is on another filesystem than {blob}, symlink instead')
+                link = 'symlink'
+
+        if link == 'symlink':
+            try:
+                os.symlink(blob, tmp_path)
+            except OSError as e:
+                logger.warning(f'Cannot link {path} to {blob}, keep it as a plain copy', exc_info=e)
+                return False
+
+        os.replace(tmp_path, path)
+        return True
+
+    @staticmethod
+    def _copy_in(path: str, blob: str):
+        # A hardlink is the cheapest copy, the content is only copied when
+        # the store is on another filesystem
+        try:
+            os.link(path, blob)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            tmp_path = blob + '.tmp'
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, blob)
+
+    def contains(self, path: str, digest: str) -> bool:
+        """Whether the file at path is already a link to its stored content"""
+        blob = self.blob_path(digest, os.path.splitext(path)[1])
+        return os.path.exists(blob) and os.path.samefile(path, blob)
+
+    def put(self, path: str, digest: str) -> bool:
+        """Store the file at path and replace it with a link to the stored content
+
+        Return True if the content was already stored, i.e. the file was a
+        duplicate and its space is released.
+        """
+
+        blob = self.blob_path(digest, os.path.splitext(path)[1])
+
+        with self._lock:
+            if os.path.exists(blob):
+                if os.path.samefile(path, blob):
+                    return False
+                if not self._link(blob, path):
+                    return False
+                logger.debug(f'File {path} is a duplicate of {blob}, linked')
+                return True
+
+            dirname = os.path.dirname(blob)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+
+            self._copy_in(path, blob)
+            if self.link == 'symlink' or not os.path.samefile(path, blob):
+                self._link(blob, path)
+
+            logger.debug(f'Stored {path} as {blob}')
+            return False
+
+    def _iter_files(self, base_dir: str) -> Iterator[str]:
+        with os.scandir(base_dir) as it:
+            subfolders = [entry.path for entry in it
+                          if entry.is_dir() and not entry.name.startswith('.')
+                          and os.path.abspath(entry.path) != self.root]
+
+        for subfolder in subfolders:
+            with os.scandir(subfolder) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and not entry.name.endswith('.part'):
+                        yield entry.path
+
+    def dedupe(self, base_dir: str, workers: int = 8,
+               known_hashes: Optional[dict[str, str]] = None) -> dict[str, int]:
+        """Move every file under base_dir into the store, linking duplicates
+
+        Files are hashed by a pool of workers, known_hashes (abspath -> digest),
+        e.g. from the download index, saves hashing those files again.
+        """
+
+        known_hashes = known_hashes or {}
+
+        def _hash(path):
+            digest = known_hashes.get(os.path.abspath(path))
+            return path, digest if digest is not None else self.hash_file(path)
+
+        stats = {'files': 0, 'stored': 0, 'duplicates': 0, 'freed_bytes': 0}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, digest in executor.map(_hash, self._iter_files(base_dir)):
+                stats['files'] += 1
+                if self.contains(path, digest):
+                    continue
+
+                size = os.path.getsize(path)
+                if self.put(path, digest):
+                    stats['duplicates'] += 1
+                    stats['freed_bytes'] += size
+                else:
+                    stats['stored'] += 1
+
+        logger.info(f"Deduplicated {stats['files']} files under {base_dir}: {stats['stored']} stored,"
+                    f" {stats['duplicates']} duplicates linked ({stats['freed_bytes']} bytes freed)")
+        return stats
@@ -0,0 +1,107 @@
+
+import threading
+from typing import Iterable
+
+from .defs import Tags
+from ..logger import MyLogger
+
+logger = MyLogger('data-fetch-utils.wallhaven.tagindex')
+
+
+class TagIndex:
+    """Inverted index from tags to the cached wallpapers having them
+
+    Both the tag id and the normalized tag name map to the set of wallpaper
+    ids, so a tag query is a set lookup and combining tags is set algebra.
+    Only wallpapers whose details, and so tags, are cached are indexed.
+    """
+
+    def __init__(self):
+        self._postings: dict[str | int, set[str]] = {}
+        self._keys_of: dict[str, frozenset[str | int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys_of)
+
+    @staticmethod
+    def _keys(json: dict) -> frozenset[str | int]:
+        keys = set()
+        for tag in json.get('tags') or []:
+            if 'id' in tag:
+                keys.add(int(tag['id']))
+            if 'name' in tag:
+                keys.add(Tags.normalize(tag['name']))
+        return frozenset(keys)
+
+    def _add(self, wid: str, json: dict):
+        for key in self._keys_of.pop(wid, ()):
+            postings = self._postings[key]
+            postings.discard(wid)
+            if not postings:
+                del self._postings[key]
+
+        # Entries without tags json have not been detailed, leave them out
+        if 'tags' not in json:
+            return
+
+        keys = self._keys(json)
+        self._keys_of[wid] = keys
+        for key in keys:
+            self._postings.setdefault(key, set()).add(wid)
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        with self._lock:
+            self._postings.clear()
+            self._keys_of.clear()
+            for wid, json in items:
+                self._add(wid, json)
+        logger.debug(f'Built tag index of {len(self._postings)} tags'
+                     f' over {len(self._keys_of)} cached wallpapers')
+
+    def add(self, wid: str, json: dict):
+        with self._lock:
+            self._add(wid, json)
+
+    def lookup(self, tag: str | int) -> set[str]:
+        """Ids of the wallpapers having the tag, given by id or name"""
+        with self._lock:
+            return set(self._postings.get(Tags.normalize(tag), ()))
+
+    def count(self, tag: str | int) -> int:
+        with self._lock:
+            return len(self._postings.get(Tags.normalize(tag), ()))
+
+    def indexed(self) -> set[str]:
+        """Ids of all wallpapers with known tags"""
+        with self._lock:
+            return set(self._keys_of)
+
+    def query(self,
+              all_of: Iterable[str | int] = (),
+              any_of: Iterable[str | int] = (),
+              none_of: Iterable[str | int] = ()) -> set[str]:
+        """Ids having every tag in all_of, at least one in any_of and none in none_of
+
+        Empty all_of and any_of match every wallpaper with known tags.
+        """
+
+        all_of, any_of, none_of = list(all_of), list(any_of), list(none_of)
+
+        # Intersect starting from the rarest tag to keep the sets small
+        all_sets = sorted((self.lookup(tag) for tag in all_of), key=len)
+        ret = all_sets[0] if all_sets else None
+        for s in all_sets[1:]:
+            ret &= s
+
+        if any_of:
+            union = set().union(*(self.lookup(tag) for tag in any_of))
+            ret = union if ret is None else ret & union
+
+        if ret is None:
+            ret = self.indexed()
+
+        for tag in none_of:
+            ret -= self.lookup(tag)
+
+        return ret
@@ -0,0 +1,71 @@
+
+import hashlib
+from typing import Optional
+
+from ..exceptions import CorruptDownloadError
+
+
+class StreamVerifier:
+    """Check a downloaded image chunk by chunk while it is streamed
+
+    The content is hashed incrementally, and the byte count and the leading
+    magic number are checked against what the server and the wallpaper info
+    claim, so the file never needs to be read back from disk.
+    """
+
+    HASH_ALGORITHM = 'sha256'
+
+    # (offset, bytes) pairs that must all match for the given file type
+    MAGIC_NUMBERS = {
+        'image/jpeg': [((0, b'\xff\xd8\xff'),)],
+        'image/png': [((0, b'\x89PNG\r\n\x1a\n'),)],
+        'image/gif': [((0, b'GIF87a'),), ((0, b'GIF89a'),)],
+        'image/webp': [((0, b'RIFF'), (8, b'WEBP'))],
+    }
+    HEADER_SIZE = 16
+
+    def __init__(self, expected_size: Optional[int] = None, file_type: Optional[str] = None):
+        """
+        expected_size: file size given by the wallpaper info, if known
+        file_type: MIME type given by the wallpaper info, e.g. image/jpeg
+        """
+        self.expected_size = expected_size
+        self.file_type = file_type
+
+        self._hash = hashlib.new(self.HASH_ALGORITHM)
+        self._header = b''
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+        if len(self._header) < self.HEADER_SIZE:
+            self._header += chunk[:self.HEADER_SIZE - len(self._header)]
+
+    @property
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def _header_matches(self) -> bool:
+        candidates = self.MAGIC_NUMBERS.get(self.file_type or '')
+        if candidates is None:
+            # Unknown file type, nothing to check against
+            return True
+
+        return any(all(self._header[offset:offset + len(magic)] == magic for offset, magic in candidate)
+                   for candidate in candidates)
+
+    def verify(self, content_length: Optional[int] = None) -> str:
+        """Raise CorruptDownloadError if any check fails, return the hex digest"""
+
+        if content_length is not None and self.size != content_length:
+            raise CorruptDownloadError(f'got {self.size} bytes while Content-Length is {content_length}')
+
+        if self.expected_size is not None and self.size != self.expected_size:
+            raise CorruptDownloadError(f'got {self.size} bytes while file size is {self.expected_size}')
+
+        if not self._header_matches():
+            raise CorruptDownloadError(f'content does not start as {self.file_type}')
+
+        return self.hexdigest